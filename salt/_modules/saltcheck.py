@@ -31,6 +31,10 @@ Unique-ID:
   kwargs:
   assertion:
   expected-return:
+  parallel:           (optional, False to never run the test concurrently)
+  timeout:            (optional, seconds before the test is reported as timed out)
+  cache:              (optional, False to never share the result of an identical call)
+  skip:               (optional, True to report the test as skipped without running it)
 
 
 Example test 1:
@@ -44,26 +48,115 @@ echo-test-hello:
   expected-return:  'hello'
 
 
+Minion config options:
+
+auto_update_master_cache: False | True | incremental
+  True copies the whole fileserver with cp.cache_master on every SaltCheck(),
+  incremental only fetches the changed saltcheck-tests files of the states
+  run, which costs one cp.hash_file round trip per file
+
+saltcheck_render_cache: True | False
+saltcheck_render_cache_size: 1000
+  rendered test files are cached in the minion cachedir, keyed on their content
+  and the grains and pillar values they read, up to this many entries
+
+saltcheck_fast_yaml: True | False
+  test files without any jinja are parsed directly with the libyaml safe
+  loader when available, instead of going through the salt renderer
+
+saltcheck_legacy_output: False | True
+  results are returned as {status, message, duration} dicts, True returns the
+  "Pass" / "Fail: ..." strings of older saltcheck versions instead
+
+saltcheck_executor: loader | caller
+  loader (default) runs test functions through the already loaded __salt__,
+  caller runs them through one process wide salt.client.Caller
+
+saltcheck_history: False | True
+saltcheck_history_days: 30
+  the status and duration of every test run by run_state_tests and
+  run_highstate_tests are kept in CACHEDIR/saltcheck/history.db, a sqlite
+  database, for this many days, see history and slowest
+
+
+Sharding:
+
+run_state_tests and run_highstate_tests take shard=i shards=n to only run the
+tests of shard i of n, split by a stable hash of the sls and test id. Given
+durations, e.g. durations=salt://ci/durations.json as exported by
+export_durations, the tests are split so shards take about the same time,
+every shard must then be given the same durations. merge_results combines
+the returns of the shards into the return of one run.
+
+
+Events:
+
+With stream=True, run_state_tests and run_highstate_tests fire an event
+tagged saltcheck/result/<sls>/<test id> with the status, message and duration
+of each test as it completes, and one tagged saltcheck/result/<sls> with the
+count of each status once all tests of the sls ran. Only the TEST RESULTS
+summary is returned.
+
+
 :codeauthor:    William Cannon <william.cannon@gmail.com>
 :maturity:      new
 '''
 from __future__ import absolute_import
+import cProfile
+import hashlib
 import logging
 import os
+import pstats
+import re
+import threading
 import time
+from collections import Counter, OrderedDict, namedtuple
+from contextlib import contextmanager
+from functools import partial
+from heapq import heappush, heapreplace
+from itertools import islice
 from json import loads, dumps
+from multiprocessing.pool import ThreadPool
+try:
+    import queue
+except ImportError:
+    import Queue as queue
 import yaml
+try:
+    import sqlite3
+    HAS_SQLITE3 = True
+except ImportError:
+    HAS_SQLITE3 = False
+try:
+    import tracemalloc
+    HAS_TRACEMALLOC = True
+except ImportError:
+    HAS_TRACEMALLOC = False
+try:
+    from yaml import CSafeLoader as YamlSafeLoader
+except ImportError:
+    from yaml import SafeLoader as YamlSafeLoader
 try:
     import salt.utils
     import salt.client
     import salt.exceptions
 except ImportError:
     pass
+try:
+    from salt.ext.six import string_types
+except ImportError:
+    try:
+        from six import string_types
+    except ImportError:
+        # salt 3006 dropped salt.ext.six, python 3 only
+        string_types = (str,)
 
 log = logging.getLogger(__name__)
 
 __virtualname__ = 'saltcheck'
 
+TEMPLATE_MARKERS = ('{{', '{%', '{#')
+
 
 def __virtual__():
     '''
@@ -72,17 +165,29 @@ def __virtual__():
     return __virtualname__
 
 
-def update_master_cache():
+def update_master_cache(incremental=False):
     '''
     Updates the master cache onto the minion - transfers all salt-check-tests
     Should be done one time before running tests, and if tests are updated
     Can be automated by setting "auto_update_master_cache: True" in minion config
 
+    With incremental=True only the saltcheck-tests files, and the sls files of
+    the states owning them, are fetched - and only when their hash on the
+    master differs from the manifest of the previous sync. With
+    "auto_update_master_cache: incremental" test runs sync the saltcheck-tests
+    of the states they run this way
+
     CLI Example:
         salt '*' saltcheck.update_master_cache
+        salt '*' saltcheck.update_master_cache incremental=True
     '''
-    __salt__['cp.cache_master']()
-    return True
+    if not incremental:
+        __salt__['cp.cache_master']()
+        return True
+    changed = {}
+    for saltenv in _get_saltenvs():
+        changed[saltenv] = _sync_saltcheck_files(saltenv)
+    return changed
 
 
 def run_test(**kwargs):
@@ -98,105 +203,654 @@ def run_test(**kwargs):
                    "args":["This works!"] }'
     '''
     # salt converts the string to a dictionary auto-magically
-    scheck = SaltCheck()
+    # ad-hoc tests do not read test files, so the master cache is not synced
+    scheck = SaltCheck(sync=False)
     test = kwargs.get('test', None)
     if test and isinstance(test, dict):
-        return scheck.run_test(test)
+        return scheck.format_result(scheck.run_test(test))
     else:
         return "Test must be a dictionary"
 
 
-def run_state_tests(state):
+def run_tests(tests, parallel=1, timeout=None, timings=False):
+    '''
+    Execute many saltcheck tests in one call and return their results with
+    a summary, sharing one engine, loader index and call cache between them
+
+    :param tests: a list of tests, identified by their position, or a
+        dictionary of {test id: test}
+    :param int parallel: number of tests run concurrently
+    :param float timeout: default number of seconds a test may run
+    :param bool timings: add the time spent per phase and the slowest tests
+
+    CLI Example::
+        salt '*' saltcheck.run_tests
+            tests='[{"module_and_function": "test.echo",
+                     "assertion": "assertEqual",
+                     "expected-return": "one",
+                     "args": ["one"]},
+                    {"module_and_function": "test.ping",
+                     "assertion": "assertTrue"}]'
+    '''
+    if isinstance(tests, (list, tuple)):
+        tests = OrderedDict(('test-{0}'.format(index), test) for index, test in enumerate(tests))
+    elif not isinstance(tests, dict):
+        return "Tests must be a list or a dictionary"
+    scheck = SaltCheck(timeout=timeout, sync=False)
+    results = scheck.run_tests(tests, parallel=parallel)
+    return _generate_out_list(scheck, {'tests': results}, timings=timings)
+
+
+def run_state_tests(state, parallel=1, timeout=None, timings=False, stream=False,
+                    shard=None, shards=None, durations=None):
     '''
     Execute all tests for a salt state and return results
     Nested states will also be tested
 
     :param str state: the name of a user defined state
+    :param int parallel: number of tests run concurrently, a test containing
+        "parallel: False" is always run on its own
+    :param float timeout: default number of seconds a test may run, overridden
+        by a "timeout" key in the test
+    :param bool timings: add the time spent per phase, per state and per test,
+        and the slowest tests, to the results
+    :param bool stream: fire a saltcheck/result/... event as each test and
+        state completes and only return the summary
+    :param int shard: with shards, only run the tests of this shard, from 0
+    :param int shards: number of shards the tests are split into
+    :param durations: balance the shards on these test durations, a dict of
+        {sls: {test id: seconds}} or the path or salt:// url of a json file
+        of it, see export_durations and merge_results
 
     CLI Example::
       salt '*' saltcheck.run_state_tests postfix
+      salt '*' saltcheck.run_state_tests postfix parallel=8
+      salt '*' saltcheck.run_state_tests postfix timeout=30
+      salt '*' saltcheck.run_state_tests postfix timings=True
+      salt '*' saltcheck.run_state_tests postfix stream=True
+      salt-call saltcheck.run_state_tests postfix shard=0 shards=4
     '''
-    scheck = SaltCheck()
-    paths = scheck.get_state_search_path_list()
-    stl = StateTestLoader(search_paths=paths)
-    results = {}
-    sls_list = _get_state_sls(state)
-    for state_name in sls_list:
-        mypath = stl.convert_sls_to_path(state_name)
-        stl.add_test_files_for_sls(mypath)
-        stl.load_test_suite()
-        results_dict = {}
-        for key, value in stl.test_dict.items():
-            result = scheck.run_test(value)
-            results_dict[key] = result
-        results[state_name] = results_dict
-    passed = 0
-    failed = 0
-    missing_tests = 0
-    for state in results:
-        if len(results[state].items()) == 0:
-            missing_tests = missing_tests + 1
-        else:
-            for dummy, val in results[state].items():
-                log.info("dummy={}, val={}".format(dummy, val))
-                if val.startswith('Pass'):
-                    passed = passed + 1
-                if val.startswith('Fail'):
-                    failed = failed + 1
-    out_list = []
-    for key, value in results.items():
-        out_list.append({key: value})
-    out_list.sort()
-    out_list.append({"TEST RESULTS": {'Passed': passed, 'Failed': failed, 'Missing Tests': missing_tests}})
+    sharding = _get_sharding(shard, shards, durations)
+    scheck = SaltCheck(timeout=timeout)
+    with scheck.timer.phase('compile'):
+        sls_list = _get_state_sls(state)
+    out_list, dummy = _run_states_tests(scheck, sls_list, parallel=parallel, timings=timings, stream=stream,
+                                        sharding=sharding)
     return out_list
 
 
-def run_highstate_tests():
+def run_highstate_tests(parallel=1, timeout=None, changed_only=False, timings=False, stream=False,
+                        shard=None, shards=None, durations=None):
     '''
     Execute all tests for a salt highstate and return results
 
+    :param int parallel: number of tests run concurrently, a test containing
+        "parallel: False" is always run on its own
+    :param float timeout: default number of seconds a test may run, overridden
+        by a "timeout" key in the test
+    :param bool changed_only: only run the tests of the states affected by sls
+        or .tst files changed since the last passing run, see run_affected_tests
+    :param bool timings: add the time spent per phase, per state and per test,
+        and the slowest tests, to the results
+    :param bool stream: fire a saltcheck/result/... event as each test and
+        state completes and only return the summary
+    :param int shard: with shards, only run the tests of this shard, from 0
+    :param int shards: number of shards the tests are split into
+    :param durations: balance the shards on these test durations, a dict of
+        {sls: {test id: seconds}} or the path or salt:// url of a json file
+        of it, see export_durations and merge_results
+
     CLI Example::
       salt '*' saltcheck.run_highstate_tests
+      salt '*' saltcheck.run_highstate_tests parallel=8
+      salt '*' saltcheck.run_highstate_tests timeout=30
+      salt '*' saltcheck.run_highstate_tests changed_only=True
+      salt '*' saltcheck.run_highstate_tests timings=True
+      salt '*' saltcheck.run_highstate_tests stream=True
+      salt-call saltcheck.run_highstate_tests shard=1 shards=4 durations=salt://ci/durations.json
+    '''
+    sharding = _get_sharding(shard, shards, durations)
+    scheck = SaltCheck(timeout=timeout)
+    with scheck.timer.phase('compile'):
+        chunks = _get_highstate_lowstate()
+        all_states = _unique_sls(chunks)
+    stl = _get_state_test_loader(scheck)
+    unchanged = None
+    if changed_only:
+        stl.sync(stl.convert_sls_to_paths(all_states))
+        stl.sync_sls_files(all_states)
+        hashes = _get_sls_hashes(stl, all_states)
+        all_states, unchanged = _get_affected_sls(stl, chunks, all_states, hashes, _load_run_manifest())
+    out_list, summary = _run_states_tests(scheck, all_states, parallel=parallel, stl=stl,
+                                          unchanged=unchanged, timings=timings, stream=stream,
+                                          sharding=sharding)
+    # a shard only sees part of the tests of a state, so cannot tell it passed
+    if changed_only and sharding is None:
+        _save_run_manifest(hashes, summary.passed)
+    return out_list
+
+
+def run_affected_tests(parallel=1, timeout=None, timings=False, stream=False):
+    '''
+    Execute the highstate tests of the states affected by changes only
+
+    An sls is affected when its sls file or .tst files changed since the last
+    run in which its tests all passed, or when it includes or holds a
+    requisite on an affected sls. Other states are not tested and are listed
+    under "Unchanged States" in the TEST RESULTS, rather than as missing tests.
+    Unless auto_update_master_cache is True, the changed sls files of the
+    highstate are fetched from the master first, those of states without
+    tests included.
+
+    CLI Example::
+      salt '*' saltcheck.run_affected_tests
+    '''
+    return run_highstate_tests(parallel=parallel, timeout=timeout, changed_only=True, timings=timings,
+                               stream=stream)
+
+
+def merge_results(results, slowest=10):
+    '''
+    Merge the returns of the shards of a sharded run into the return of a
+    single run
+
+    Test counts, phase and state times are summed, Unchanged and the compile
+    and function index times are the largest of the shards. Warnings are
+    added when shards are missing or were split on different shard counts
+    or durations, as tests may then have run twice or not at all
+
+    :param list results: the returns of run_state_tests or
+        run_highstate_tests, one per shard
+
+    CLI Example::
+      salt-call saltcheck.merge_results '[<return of shard 0>, <return of shard 1>]'
+    '''
+    states = {}
+    summary = Counter()
+    largest = {}
+    ratios = []
+    phases = Counter()
+    state_times = Counter()
+    slowest_tests = []
+    has_timings = False
+    unchanged = set()
+    splits = set()
+    shards_seen = set()
+    for out_list in results:
+        for entry in out_list[:-1]:
+            for state, tests in entry.items():
+                states.setdefault(state, OrderedDict()).update(tests)
+        shard_summary = out_list[-1]['TEST RESULTS']
+        if 'Shard' in shard_summary:
+            shard, shards = shard_summary['Shard'].split('/')
+            shards_seen.add(int(shard))
+            splits.add((int(shards), shard_summary.get('Shard Durations')))
+        for key in ('Passed', 'Failed', 'Errors', 'Skipped', 'Timed Out', 'Missing Tests'):
+            summary[key] += shard_summary.get(key, 0)
+        for key in ('Compile Time', 'Function Index Build Time', 'Unchanged'):
+            if shard_summary.get(key) is not None:
+                largest[key] = max(largest.get(key, 0), shard_summary[key])
+        unchanged.update(shard_summary.get('Unchanged States', []))
+        if shard_summary.get('Call Cache Hit Ratio') is not None:
+            ratios.append(shard_summary['Call Cache Hit Ratio'])
+        if 'Timings' in shard_summary:
+            has_timings = True
+            phases.update(shard_summary['Timings']['Phases'])
+            state_times.update(shard_summary['Timings']['States'])
+            slowest_tests.extend(shard_summary['Timings']['Slowest Tests'])
+    out_list = [{state: states[state]} for state in sorted(states)]
+    merged = dict(summary)
+    merged.update({'Compile Time': largest.get('Compile Time'),
+                   'Function Index Build Time': largest.get('Function Index Build Time'),
+                   'Call Cache Hit Ratio': sum(ratios) / len(ratios) if ratios else 0.0})
+    if 'Unchanged' in largest:
+        merged['Unchanged'] = largest['Unchanged']
+        merged['Unchanged States'] = sorted(unchanged)
+    warnings = []
+    if len(splits) > 1:
+        warnings.append("shards were split on different shard counts or durations")
+    elif splits and shards_seen != set(range(list(splits)[0][0])):
+        warnings.append("missing the returns of shards {0}".format(
+            sorted(set(range(list(splits)[0][0])) - shards_seen)))
+    if warnings:
+        for warning in warnings:
+            log.warning("saltcheck merge_results: {0}".format(warning))
+        merged['Warnings'] = warnings
+    if has_timings:
+        merged['Timings'] = {'Phases': dict(phases),
+                             'States': dict(state_times),
+                             'Slowest Tests': sorted(slowest_tests, key=lambda test: test['duration'],
+                                                     reverse=True)[:slowest]}
+    out_list.append({'TEST RESULTS': merged})
+    return out_list
+
+
+def history(state=None, test=None, limit=50):
+    '''
+    Return the most recent test results kept in the run history, newest first
+
+    Requires "saltcheck_history: True" in the minion config
+
+    :param str state: only the results of the tests of this sls
+    :param str test: only the results of this test id
+    :param int limit: number of results returned
+
+    CLI Example::
+      salt '*' saltcheck.history
+      salt '*' saltcheck.history state=apache test=apache-installed limit=10
+    '''
+    if not HAS_SQLITE3:
+        return "The run history requires the python sqlite3 module"
+    return ResultHistory().history(state=state, test=test, limit=limit)
+
+
+def slowest(state=None, days=None, limit=10):
+    '''
+    Return the tests with the longest mean duration in the run history, with
+    how often they ran and did not pass
+
+    Requires "saltcheck_history: True" in the minion config
+
+    :param str state: only the tests of this sls
+    :param float days: only the runs of the last days
+    :param int limit: number of tests returned
+
+    CLI Example::
+      salt '*' saltcheck.slowest
+      salt '*' saltcheck.slowest state=apache days=7
+    '''
+    if not HAS_SQLITE3:
+        return "The run history requires the python sqlite3 module"
+    return ResultHistory().slowest(state=state, days=days, limit=limit)
+
+
+def export_durations(path=None, days=None):
+    '''
+    Return the mean duration of every test in the run history as
+    {sls: {test id: seconds}}, the durations to give to every shard of a
+    sharded run
+
+    Requires "saltcheck_history: True" in the minion config
+
+    :param str path: write the durations to this json file instead
+    :param float days: only the runs of the last days
+
+    CLI Example::
+      salt-call saltcheck.export_durations
+      salt-call saltcheck.export_durations path=/srv/salt/ci/durations.json days=7
+    '''
+    if not HAS_SQLITE3:
+        return "The run history requires the python sqlite3 module"
+    durations = ResultHistory().durations(days=days)
+    if path is None:
+        return durations
+    with open(path, 'w') as myfile:
+        myfile.write(dumps(durations, sort_keys=True))
+    return path
+
+
+def profile_run(state=None, memory=False, top=10, **kwargs):
     '''
-    scheck = SaltCheck()
+    Profile a run of run_state_tests, or run_highstate_tests when no state is
+    given, with cProfile and optionally tracemalloc
+
+    The pstats file, and the top memory allocation sites when memory=True, are
+    written to CACHEDIR/saltcheck/. Only the calling thread is profiled, so
+    use the default parallel=1 to see the test execution.
+
+    :param str state: the state to test, the highstate when omitted
+    :param bool memory: also trace memory allocations, which slows the run
+    :param int top: number of functions and allocation sites reported
+    :param kwargs: passed on to the runner
+
+    CLI Example::
+      salt '*' saltcheck.profile_run
+      salt '*' saltcheck.profile_run apache memory=True
+    '''
+    kwargs = dict((key, val) for key, val in kwargs.items() if not key.startswith('__'))
+    profile_dir = os.path.join(__opts__['cachedir'], 'saltcheck')
+    if not os.path.isdir(profile_dir):
+        os.makedirs(profile_dir)
+    prefix = os.path.join(profile_dir, 'profile-{0}'.format(time.strftime('%Y%m%d-%H%M%S')))
+    memory = memory and HAS_TRACEMALLOC
+    if memory:
+        tracemalloc.start()
+    profiler = cProfile.Profile()
+    start = time.time()
+    profiler.enable()
+    try:
+        if state:
+            results = run_state_tests(state, **kwargs)
+        else:
+            results = run_highstate_tests(**kwargs)
+    finally:
+        profiler.disable()
+        elapsed = time.time() - start
+        if memory:
+            snapshot = tracemalloc.take_snapshot()
+            dummy, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+    profiler.dump_stats(prefix + '.pstats')
+    stats = pstats.Stats(profiler)
+    top_functions = []
+    for func, (dummy, ncalls, tottime, cumtime, dummy) in sorted(
+            stats.stats.items(), key=lambda item: item[1][3], reverse=True)[:top]:
+        top_functions.append('{0}:{1}({2}) calls={3} tottime={4:.4f} cumtime={5:.4f}'.format(
+            func[0], func[1], func[2], ncalls, tottime, cumtime))
+    summary = {'Run Time': elapsed,
+               'Profile': prefix + '.pstats',
+               'Top Cumulative': top_functions,
+               'TEST RESULTS': results[-1]['TEST RESULTS']}
+    if memory:
+        top_allocations = [str(stat) for stat in snapshot.statistics('lineno')[:top]]
+        with open(prefix + '-memory.txt', 'w') as myfile:
+            myfile.write('peak: {0} bytes\n'.format(peak))
+            myfile.write('\n'.join(top_allocations) + '\n')
+        summary['Peak Memory'] = peak
+        summary['Top Allocations'] = top_allocations
+        summary['Memory Profile'] = prefix + '-memory.txt'
+    return summary
+
+
+def _get_state_test_loader(scheck):
+    '''return a StateTestLoader configured from the minion config'''
     paths = scheck.get_state_search_path_list()
-    stl = StateTestLoader(search_paths=paths)
-    results = {}
-    sls_list = _get_top_states()
-    all_states = []
-    for top_state in sls_list:
-        sls_list = _get_state_sls(top_state)
-        for state in sls_list:
-            if state not in all_states:
-                all_states.append(state)
-
-    for state_name in all_states:
+    # cp.cache_master copied everything, the incremental sync only the saltcheck files
+    refresh = not scheck.auto_update_master_cache or scheck.auto_update_master_cache == 'incremental'
+    return StateTestLoader(search_paths=paths, refresh=refresh,
+                           render_cache=_get_render_cache(),
+                           fast_yaml=__salt__['config.get']('saltcheck_fast_yaml', True),
+                           timer=scheck.timer)
+
+
+def _iter_states_results(scheck, sls_list, parallel=1, stl=None, sharding=None, results=None):
+    '''
+    load and run the tests of every sls, yielding (sls, test id, result) as
+    each test completes and (sls, None, missing) once all tests of an sls ran
+
+    Test files are loaded one at a time, so only the tests of the file being
+    run are held. With a TestSharding only the tests of its shard are run.
+    Given a results dict, it gets an OrderedDict per sls seeded with the test
+    ids in test order, for the results to be filled in as they complete.
+    '''
+    stl = stl or _get_state_test_loader(scheck)
+    stl.sync(stl.convert_sls_to_paths(sls_list))
+    for state_name in sls_list:
+        start = time.time()
+        found = []
         mypath = stl.convert_sls_to_path(state_name)
         stl.add_test_files_for_sls(mypath)
-        stl.load_test_suite()
-        results_dict = {}
-        for key, value in stl.test_dict.items():
-            result = scheck.run_test(value)
-            results_dict[key] = result
-        results[state_name] = results_dict
-    passed = 0
-    failed = 0
-    missing_tests = 0
-    for state in results:
-        if len(results[state].items()) == 0:
-            missing_tests = missing_tests + 1
+        if results is not None:
+            results[state_name] = OrderedDict()
+        plans = _iter_state_plans(scheck, stl, state_name, sharding, found,
+                                  None if results is None else results[state_name])
+        for test_id, result in scheck.iter_plans(plans, parallel=parallel):
+            yield state_name, test_id, result
+        scheck.state_timings[state_name] = time.time() - start
+        yield state_name, None, not found and (sharding is None or sharding.owns_state(state_name))
+
+
+def _iter_state_plans(scheck, stl, state_name, sharding, found, order=None):
+    '''
+    compile the gathered test files of an sls one file at a time, yielding
+    (test id, TestPlan), found gets an item once any test is found and, with
+    sharding, only the tests of the shard are compiled and added to order
+    '''
+    for tests, dummy in stl.iter_test_suite():
+        if tests and not found:
+            found.append(True)
+        if sharding is not None:
+            tests = sharding.select(state_name, tests)
+        plans = scheck.compile_tests(tests)
+        if order is not None:
+            order.update((key, None) for key in plans)
+        for item in plans.items():
+            yield item
+
+
+def _run_states_tests(scheck, sls_list, parallel=1, stl=None, unchanged=None, timings=False,
+                      stream=False, sharding=None):
+    '''
+    run the tests of every sls, return the saltcheck output and the RunSummary
+
+    With stream, a saltcheck/result/<sls>/<test id> event is fired as each
+    test completes and a saltcheck/result/<sls> event as each sls completes,
+    and the output only holds the summary
+    '''
+    result_history = _get_result_history()
+    summary = RunSummary(record=result_history is not None)
+    results = {}
+    for state_name, test_id, result in _iter_states_results(scheck, sls_list, parallel=parallel, stl=stl,
+                                                            sharding=sharding,
+                                                            results=None if stream else results):
+        if test_id is None:
+            counts = summary.end_state(state_name, missing=result)
+            if stream:
+                _fire_result_event([state_name], {'state': state_name,
+                                                  'duration': scheck.state_timings[state_name],
+                                                  'counts': counts})
+            continue
+        summary.add(state_name, test_id, result)
+        if stream:
+            data = result.to_dict()
+            data.update({'state': state_name, 'test': test_id})
+            _fire_result_event([state_name, test_id], data)
+        else:
+            results[state_name][test_id] = result
+    shard = None if sharding is None else '{0}/{1}'.format(sharding.shard, sharding.shards)
+    if result_history is not None:
+        result_history.record(summary.records, shard=shard)
+    out_list = _generate_out_list(scheck, results, unchanged=unchanged, timings=timings, summary=summary)
+    if shard is not None:
+        out_list[-1]['TEST RESULTS']['Shard'] = shard
+        out_list[-1]['TEST RESULTS']['Shard Durations'] = sharding.fingerprint
+    return out_list, summary
+
+
+def _get_sharding(shard, shards, durations=None):
+    '''return the TestSharding of a run, None when not sharded'''
+    if shard is None and shards is None:
+        return None
+    if shard is None or shards is None:
+        raise salt.exceptions.SaltInvocationError("shard and shards must be given together")
+    return TestSharding(shard, shards, durations=_load_test_durations(durations) if durations else None)
+
+
+def _load_test_durations(durations):
+    '''
+    return {(sls, test id): seconds} from a {sls: {test id: seconds}} dict, or
+    the path or salt:// url of a json file of it
+    '''
+    if not isinstance(durations, dict):
+        path = durations
+        if path.startswith('salt://'):
+            path = __salt__['cp.cache_file'](path)
+        try:
+            with open(path, 'r') as myfile:
+                durations = loads(myfile.read())
+        except (IOError, OSError, TypeError, ValueError) as err:
+            raise salt.exceptions.SaltInvocationError(
+                "could not load the test durations from {0}: {1}".format(path, err))
+    try:
+        return dict(((sls, str(test_id)), float(seconds)) for sls, tests in durations.items()
+                    for test_id, seconds in tests.items())
+    except (AttributeError, TypeError, ValueError):
+        raise salt.exceptions.SaltInvocationError("durations must be {sls: {test id: seconds}}")
+
+
+def _fire_result_event(parts, data):
+    '''fire a saltcheck/result/... event, a failure to fire never fails the run'''
+    tag = '/'.join(['saltcheck', 'result'] + [str(part) for part in parts])
+    try:
+        __salt__['event.send'](tag, data)
+    except Exception as err:  # pylint: disable=broad-except
+        log.info("saltcheck failed to fire event {0}: {1}".format(tag, err))
+
+
+def _get_run_manifest_path():
+    '''return the path of the {sls: hash} manifest of the last run'''
+    return os.path.join(__opts__['cachedir'], 'saltcheck', 'last-run.json')
+
+
+def _load_run_manifest():
+    '''load the {sls: hash} manifest of the last run'''
+    try:
+        with open(_get_run_manifest_path(), 'r') as myfile:
+            return loads(myfile.read())
+    except (IOError, OSError, ValueError):
+        return {}
+
+
+def _save_run_manifest(hashes, passed):
+    '''
+    record the hashes of the states which ran without failures, a failed
+    state stays affected until its tests pass
+
+    :param dict passed: {sls: True when all its tests passed}
+    '''
+    manifest = _load_run_manifest()
+    for sls, value in passed.items():
+        if value:
+            manifest[sls] = hashes.get(sls)
         else:
-            for dummy, val in results[state].items():
-                log.info("dummy={}, val={}".format(dummy, val))
-                if val.startswith('Pass'):
-                    passed = passed + 1
-                if val.startswith('Fail'):
-                    failed = failed + 1
+            manifest.pop(sls, None)
+    manifest_path = _get_run_manifest_path()
+    if not os.path.isdir(os.path.dirname(manifest_path)):
+        os.makedirs(os.path.dirname(manifest_path))
+    with open(manifest_path, 'w') as myfile:
+        myfile.write(dumps(manifest))
+
+
+def _find_sls_file(stl, sls):
+    '''return the local path of the sls file of an sls, or None'''
+    sls_path = stl.convert_sls_to_path(sls)
+    for path in stl.search_paths:
+        for candidate in (sls_path + '.sls', os.path.join(sls_path, 'init.sls')):
+            full_path = os.path.join(path, candidate)
+            if os.path.isfile(full_path):
+                return full_path
+    return None
+
+
+def _get_sls_hashes(stl, sls_list):
+    '''return {sls: hash of its sls file and .tst files}'''
+    hashes = {}
+    for sls in sls_list:
+        hasher = hashlib.sha256()
+        sls_file = _find_sls_file(stl, sls)
+        test_files = []
+        for path in stl.search_paths:
+            if os.path.isdir(path):
+                test_files.extend(stl.get_discovery_index(path).lookup(stl.convert_sls_to_path(sls)))
+        for filepath in [sls_file] + sorted(test_files):
+            hasher.update((filepath or '').encode('utf-8'))
+            hasher.update((_local_file_hash(filepath, 'sha256') if filepath else '').encode('utf-8'))
+        hashes[sls] = hasher.hexdigest() if sls_file else None
+    return hashes
+
+
+def _get_sls_includes(filepath, sls):
+    '''
+    return the sls included by an sls file, relative includes and the
+    {{ sls }}, {{ slspath }}, {{ slsdotpath }} and {{ tpldir }} names resolved
+    '''
+    p_comps = sls.split('.')
+    if filepath.endswith('init.sls'):
+        p_comps.append('init')
+    names = {'sls': sls, 'slspath': '.'.join(p_comps[:-1]), 'slsdotpath': '.'.join(p_comps[:-1]),
+             'tpldir': '.'.join(p_comps[:-1])}
+    includes = []
+    with open(filepath, 'r') as myfile:
+        in_include = False
+        for line in myfile:
+            if re.match(r'^include\s*:', line):
+                in_include = True
+                continue
+            if not in_include:
+                continue
+            if line.lstrip().startswith('-'):
+                item = re.sub(r'{{-?\s*(\w+)[^}]*}}',
+                              lambda match: names.get(match.group(1), match.group(0)), line)
+                match = re.match(r'^\s*-\s*[\'"]?([\w.\-/]+)[\'"]?\s*(#.*)?$', item)
+                if match:
+                    includes.append(match.group(1).replace('/', '.'))
+                else:
+                    log.info("unable to resolve the include {} of {}".format(line.strip(), sls))
+            elif line.strip() and not line.lstrip().startswith(('#', '{')):
+                in_include = False
+    resolved = []
+    for include in includes:
+        levels = len(include) - len(include.lstrip('.'))
+        if levels:
+            # salt resolves .name in the package of the sls, every extra dot goes one level up
+            if levels > len(p_comps):
+                log.info("include {} of {} goes above the top level".format(include, sls))
+                continue
+            include = '.'.join(p_comps[:-levels] + [include[levels:]])
+        resolved.append(include)
+    return resolved
+
+
+def _get_affected_sls(stl, chunks, sls_list, hashes, manifest):
+    '''
+    split sls_list into (affected, unchanged) sls: the sls whose hash is new or
+    changed, plus every sls including or holding a requisite on those
+    '''
+    requisites = ('require', 'watch', 'prereq', 'onchanges', 'onfail', 'use', 'listen')
+    by_id = {}
+    for chunk in chunks:
+        if isinstance(chunk, dict):
+            by_id[(chunk.get('state'), chunk.get('__id__'))] = chunk['__sls__']
+            by_id[(chunk.get('state'), chunk.get('name'))] = chunk['__sls__']
+    # dependents[sls] is the set of sls to re-test when sls changes
+    dependents = {}
+    for chunk in chunks:
+        if not isinstance(chunk, dict):
+            continue
+        for req_type in requisites + tuple(req + '_in' for req in requisites):
+            for req in chunk.get(req_type, None) or []:
+                if not isinstance(req, dict):
+                    continue
+                for state, name in req.items():
+                    target = name if state == 'sls' else by_id.get((state, name))
+                    if not target or target == chunk['__sls__']:
+                        continue
+                    if req_type.endswith('_in'):
+                        dependents.setdefault(chunk['__sls__'], set()).add(target)
+                    else:
+                        dependents.setdefault(target, set()).add(chunk['__sls__'])
+    for sls in sls_list:
+        sls_file = _find_sls_file(stl, sls)
+        if sls_file:
+            for include in _get_sls_includes(sls_file, sls):
+                dependents.setdefault(include, set()).add(sls)
+    pending = [sls for sls in sls_list if hashes.get(sls) is None or manifest.get(sls) != hashes[sls]]
+    affected = set(pending)
+    while pending:
+        for dependent in dependents.get(pending.pop(), ()):
+            if dependent not in affected:
+                affected.add(dependent)
+                pending.append(dependent)
+    return ([sls for sls in sls_list if sls in affected],
+            [sls for sls in sls_list if sls not in affected])
+
+
+def _generate_out_list(scheck, results, unchanged=None, timings=False, summary=None):
+    '''
+    summarize the results of a run into the saltcheck return format, the
+    summary is built from the results unless already fed with them
+    '''
+    if summary is None:
+        summary = RunSummary()
+        for key, value in results.items():
+            for test_id, result in value.items():
+                summary.add(key, test_id, result)
+            summary.end_state(key, missing=not value)
     out_list = []
-    for key, value in results.items():
-        out_list.append({key: value})
-    out_list.sort()
-    out_list.append({"TEST RESULTS": {'Passed': passed, 'Failed': failed, 'Missing Tests': missing_tests}})
+    for key, value in sorted(results.items()):
+        out_list.append({key: OrderedDict((test_id, scheck.format_result(result, timings=timings))
+                                          for test_id, result in value.items())})
+    out_list.append({"TEST RESULTS": summary.to_dict(scheck, unchanged=unchanged, timings=timings)})
     return out_list
 
 
@@ -208,201 +862,1023 @@ def _render_file(file_path):
     return rendered
 
 
-def _is_valid_module(module):
-    '''return a list of all modules available on minion'''
-    modules = __salt__['sys.list_modules']()
-    return bool(module in modules)
+def _render_file_normalized(file_path):
+    '''render a file into plain dicts and lists'''
+    # use the salt renderer module to interpret jinja and etc
+    tests = _render_file(file_path)
+    # use json as a convenient way to convert the OrderedDicts from salt renderer
+    return loads(dumps(tests))
+
+
+def _load_plain_yaml(file_path):
+    '''
+    parse a test file without any template markers straight into plain
+    dicts, return None for templated files which need the salt renderer
+    '''
+    with __utils__['files.fopen'](file_path, 'r') as myfile:
+        contents = myfile.read()
+    if contents.startswith('#!') or any(marker in contents for marker in TEMPLATE_MARKERS):
+        return None
+    return yaml.load(contents, Loader=YamlSafeLoader) or {}
+
+
+def _get_render_cache():
+    '''return a RenderCache as configured in the minion config, or None'''
+    if not __salt__['config.get']('saltcheck_render_cache', True):
+        return None
+    return RenderCache(max_entries=int(__salt__['config.get']('saltcheck_render_cache_size', 1000)))
+
+
+def _get_result_history():
+    '''return a ResultHistory as configured in the minion config, or None'''
+    if not HAS_SQLITE3 or not __salt__['config.get']('saltcheck_history', False):
+        return None
+    return ResultHistory(retention_days=float(__salt__['config.get']('saltcheck_history_days', 30)))
 
 
 def _get_auto_update_cache_value():
     '''return the config value of auto_update_master_cache'''
-    __salt__['config.get']('auto_update_master_cache')
-    return True
+    value = __salt__['config.get']('auto_update_master_cache', False)
+    if isinstance(value, string_types) and value.lower() in ('false', 'no', 'off', ''):
+        return False
+    return value
 
 
-def _is_valid_function(module_name, function):
-    '''Determine if a function is valid for a module'''
-    try:
-        functions = __salt__['sys.list_functions'](module_name)
-    except salt.exceptions.SaltException:
-        functions = ["unable to look up functions"]
-    return "{0}.{1}".format(module_name, function) in functions
+def _get_saltenvs():
+    '''return the saltenvs searched for states, most specific first'''
+    saltenvs = []
+    environment = __opts__.get('environment', None)
+    if environment:
+        saltenvs.append(environment)
+    if 'base' not in saltenvs:
+        saltenvs.append('base')
+    return saltenvs
+
+
+def _get_cache_root(saltenv):
+    '''return the local directory the fileserver of a saltenv is cached into'''
+    return os.path.join(__opts__['cachedir'], 'files', saltenv)
 
 
-def _get_top_states():
-    ''' equivalent to a salt cli: salt web state.show_top'''
-    alt_states = []
+def _get_manifest_path(saltenv):
+    '''return the path of the persisted hash manifest for a saltenv'''
+    return os.path.join(__opts__['cachedir'], 'saltcheck', 'manifest-{0}.json'.format(saltenv))
+
+
+def _load_manifest(saltenv):
+    '''load the {salt path: hash} manifest of the previous sync'''
+    manifest_path = _get_manifest_path(saltenv)
+    if not os.path.isfile(manifest_path):
+        return {}
     try:
-        returned = __salt__['state.show_top']()
-        for i in returned['base']:
-            alt_states.append(i)
-    except Exception:
-        raise
-    # log.info("top states: {}".format(alt_states))
-    return alt_states
+        with __utils__['files.fopen'](manifest_path, 'r') as myfile:
+            return loads(myfile.read())
+    except (IOError, OSError, ValueError):
+        log.info("unable to read manifest {}, doing a full sync".format(manifest_path))
+        return {}
+
+
+def _save_manifest(saltenv, manifest):
+    '''persist the {salt path: hash} manifest of a sync'''
+    manifest_path = _get_manifest_path(saltenv)
+    manifest_dir = os.path.dirname(manifest_path)
+    if not os.path.isdir(manifest_dir):
+        os.makedirs(manifest_dir)
+    with __utils__['files.fopen'](manifest_path, 'w') as myfile:
+        myfile.write(dumps(manifest))
+
+
+def _local_file_hash(filepath, hash_type):
+    '''hash a file in the local cache the same way the master does'''
+    if not os.path.isfile(filepath):
+        return None
+    hasher = hashlib.new(hash_type)
+    with open(filepath, 'rb') as myfile:
+        for chunk in iter(lambda: myfile.read(65536), b''):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+def _get_saltcheck_master_files(saltenv, sls_paths=None):
+    '''
+    list the saltcheck-tests files on the master, plus the sls files of the
+    states owning a saltcheck-tests directory, given sls_paths only those of
+    the saltcheck-tests directories of these sls paths
+    '''
+    master_files = __salt__['cp.list_master'](saltenv)
+    test_files = []
+    state_dirs = set()
+    for path in master_files:
+        parts = path.split('/')
+        if 'saltcheck-tests' in parts[:-1]:
+            state_dir = '/'.join(parts[:parts.index('saltcheck-tests')])
+            if sls_paths is not None and state_dir not in sls_paths:
+                continue
+            test_files.append(path)
+            state_dirs.add(state_dir)
+    sls_files = [path for path in master_files
+                 if path.endswith('.sls') and path.rpartition('/')[0] in state_dirs]
+    return test_files + sls_files
+
+
+def _fetch_changed_files(saltenv, paths, manifest):
+    '''
+    fetch the salt paths of a saltenv whose master hash differs from the
+    manifest, or from the local copy for paths new to the manifest, and
+    record their master hash in the manifest
+    returns the list of fetched salt paths
+    '''
+    cache_root = _get_cache_root(saltenv)
+    changed = []
+    for path in paths:
+        master_hash = __salt__['cp.hash_file']('salt://' + path, saltenv)
+        if not master_hash:
+            continue
+        hsum = master_hash.get('hsum')
+        local_path = os.path.join(cache_root, *path.split('/'))
+        if path in manifest:
+            unchanged = manifest[path] == hsum and os.path.isfile(local_path)
+        else:
+            unchanged = _local_file_hash(local_path, master_hash.get('hash_type', 'md5')) == hsum
+        manifest[path] = hsum
+        if not unchanged:
+            changed.append(path)
+    if changed:
+        __salt__['cp.cache_files'](['salt://' + path for path in changed], saltenv)
+    return changed
+
+
+def _sync_saltcheck_files(saltenv, sls_paths=None):
+    '''
+    fetch the saltcheck files of a saltenv whose master hash changed since the
+    last sync, and drop cached test files removed from the master, given
+    sls_paths only the saltcheck-tests directories of these sls paths
+
+    The master is listed once, every listed file then costs one cp.hash_file
+    round trip, the changed files are fetched with one cp.cache_files call.
+    returns the list of fetched salt paths
+    '''
+    manifest = _load_manifest(saltenv)
+    previous = dict(manifest)
+    cache_root = _get_cache_root(saltenv)
+    sls_paths = None if sls_paths is None else set(path.replace(os.sep, '/') for path in sls_paths)
+    paths = _get_saltcheck_master_files(saltenv, sls_paths)
+    changed = _fetch_changed_files(saltenv, paths, manifest)
+    for path in set(manifest) - set(paths):
+        parts = path.split('/')
+        if 'saltcheck-tests' not in parts[:-1]:
+            continue
+        if sls_paths is not None and '/'.join(parts[:parts.index('saltcheck-tests')]) not in sls_paths:
+            continue
+        local_path = os.path.join(cache_root, *path.split('/'))
+        if os.path.isfile(local_path):
+            os.remove(local_path)
+        del manifest[path]
+    # an unchanged manifest keeps its stamp, see DiscoveryIndex.refresh
+    if manifest != previous:
+        _save_manifest(saltenv, manifest)
+    log.info("synced saltenv {}: {} changed of {} files".format(saltenv, len(changed), len(paths)))
+    return changed
+
+
+def _sync_sls_files(saltenv, sls_list):
+    '''
+    fetch the sls files of sls_list whose master hash changed since the last
+    sync, the sls files of states without tests are not kept up to date by
+    the saltcheck files sync
+    returns the list of fetched salt paths
+    '''
+    master_files = set(__salt__['cp.list_master'](saltenv))
+    paths = []
+    for sls in sls_list:
+        sls_path = sls.replace('.', '/')
+        for candidate in (sls_path + '.sls', sls_path + '/init.sls'):
+            if candidate in master_files:
+                paths.append(candidate)
+                break
+    manifest = _load_manifest(saltenv)
+    previous = dict(manifest)
+    changed = _fetch_changed_files(saltenv, paths, manifest)
+    if manifest != previous:
+        _save_manifest(saltenv, manifest)
+    log.info("synced saltenv {}: {} changed of {} sls files".format(saltenv, len(changed), len(paths)))
+    return changed
+
+
+def _unique_sls(chunks):
+    '''return the sls of low chunks in order, without duplicates'''
+    seen = set()
+    sls_list = []
+    for chunk in chunks:
+        if not isinstance(chunk, dict):
+            # a compile error is returned as a list of strings
+            log.info("unable to compile states: {}".format(chunk))
+            continue
+        sls = chunk.get('__sls__')
+        if sls and sls not in seen:
+            seen.add(sls)
+            sls_list.append(sls)
+    return sls_list
+
+
+def _get_highstate_lowstate():
+    ''' equivalent to a salt cli: salt web state.show_lowstate'''
+    return __salt__['state.show_lowstate']()
 
 
 def _get_state_sls(state):
     ''' equivalent to a salt cli: salt web state.show_low_sls STATE'''
-    sls_list_state = []
     try:
         returned = __salt__['state.show_low_sls'](state)
-        for i in returned:
-            if i['__sls__'] not in sls_list_state:
-                sls_list_state.append(i['__sls__'])
     except Exception:
         # raise
-        pass
-    return sls_list_state
+        return []
+    return _unique_sls(returned)
 
-def _refresh_saltcheck_tests_dir(dirpath):
-    ''' equivalent to:
-           rm -rf dest-dir
-           salt cp.get_dir salt://STATE/saltcheck-tests dest-dir'''
-    __salt__['file.remove'](dirpath)
 
-    mypath_list = dirpath.split(os.sep)
-    mypath_list = [i for i in mypath_list if i != '']  # removing empty chars
+def _map_cache_path(dirpath):
+    '''
+    map a path in the local fileserver cache to its saltenv and salt path
+    e.g. CACHEDIR/files/base/apache/saltcheck-tests -> ('base', 'apache/saltcheck-tests')
+    '''
+    dirpath = os.path.abspath(dirpath)
+    for saltenv in _get_saltenvs():
+        cache_root = os.path.abspath(_get_cache_root(saltenv))
+        relpath = os.path.relpath(dirpath, cache_root)
+        if relpath != os.pardir and not relpath.startswith(os.pardir + os.sep):
+            return saltenv, '/'.join(relpath.split(os.sep))
+    return None, None
+
 
-    state = mypath_list[6:]
-    state = os.path.join(*state)
+def _get_executor_value():
+    '''return the config value of saltcheck_executor, "loader" or "caller"'''
+    return __salt__['config.get']('saltcheck_executor', 'loader')
 
-    source = "salt://" + state
-    dest = dirpath
-    __salt__['cp.get_dir'](source, dirpath)
-    return
+
+class LoaderExecutor(object):
+    '''
+    Execution backend dispatching straight into the already loaded __salt__
+    '''
+
+    @staticmethod
+    def cmd(fun, *args, **kwargs):
+        '''call a salt function in process'''
+        return __salt__[fun](*args, **kwargs)
+
+    @staticmethod
+    def resolve(fun):
+        '''return the loaded function itself'''
+        return __salt__[fun]
+
+
+class CallerExecutor(object):
+    '''
+    Execution backend going through a salt.client.Caller, for isolation
+
+    The Caller sets up its own loader and config, so it is created on first
+    use and shared by every SaltCheck in the process
+    '''
+    _caller = None
+    _lock = threading.Lock()
+
+    @classmethod
+    def get_caller(cls):
+        '''return the process wide Caller, creating it if needed'''
+        if cls._caller is None:
+            with cls._lock:
+                if cls._caller is None:
+                    cls._caller = salt.client.Caller()
+        return cls._caller
+
+    def cmd(self, fun, *args, **kwargs):
+        '''call a salt function through the shared Caller'''
+        return self.get_caller().cmd(fun, *args, **kwargs)
+
+    def resolve(self, fun):
+        '''return a callable running fun through the shared Caller'''
+        return partial(self.cmd, fun)
+
+
+EXECUTORS = {'loader': LoaderExecutor,
+             'caller': CallerExecutor}
+
+
+MAX_RENDER_LENGTH = 256
+MAX_DIFF_ITEMS = 5
+
+MAX_RENDER_ITEMS = 10
+MAX_RENDER_DEPTH = 3
+MAX_RENDER_LEAF = 64
+
+
+def _bounded_repr(value, depth=MAX_RENDER_DEPTH):
+    '''repr a value, looking at no more than MAX_RENDER_ITEMS items per container'''
+    if isinstance(value, dict):
+        if depth <= 0:
+            return '{...}'
+        items = ['{0}: {1}'.format(_bounded_repr(key, depth - 1), _bounded_repr(val, depth - 1))
+                 for key, val in islice(value.items(), MAX_RENDER_ITEMS)]
+        if len(value) > MAX_RENDER_ITEMS:
+            items.append('...')
+        return '{' + ', '.join(items) + '}'
+    if isinstance(value, (list, tuple, set, frozenset)):
+        brackets = '[]' if isinstance(value, list) else '()' if isinstance(value, tuple) else '{}'
+        if depth <= 0:
+            return brackets[0] + '...' + brackets[1]
+        items = [_bounded_repr(val, depth - 1) for val in islice(value, MAX_RENDER_ITEMS)]
+        if len(value) > MAX_RENDER_ITEMS:
+            items.append('...')
+        return brackets[0] + ', '.join(items) + brackets[1]
+    if isinstance(value, (string_types, bytes, bytearray)):
+        # sliced before the repr, so a huge payload is never copied whole
+        if len(value) > MAX_RENDER_LEAF:
+            return repr(value[:MAX_RENDER_LEAF - 3]) + '...'
+        return repr(value)
+    text = repr(value)
+    if len(text) > MAX_RENDER_LEAF:
+        text = text[:MAX_RENDER_LEAF - 3] + '...'
+    return text
+
+
+def _bounded_format(value, limit=MAX_RENDER_LENGTH):
+    '''
+    render a value for a failure message in at most limit characters,
+    containers are only walked as far as needed
+    '''
+    if isinstance(value, (dict, list, tuple, set, frozenset)):
+        text = _bounded_repr(value)
+    elif isinstance(value, string_types):
+        text = value[:limit + 1]
+    elif isinstance(value, (bytes, bytearray)):
+        text = str(value[:limit + 1])
+    else:
+        text = str(value)
+    if len(text) > limit:
+        text = text[:limit - 3] + '...'
+    return text
+
+
+def _structural_diff(expected, returned, max_items=MAX_DIFF_ITEMS):
+    '''
+    describe the first max_items differing keys or indices of two dicts or two
+    lists, return None for other types
+    '''
+    diffs = []
+    count = 0
+    if isinstance(expected, dict) and isinstance(returned, dict):
+        for key in expected:
+            if key not in returned:
+                diff = "missing key {0}".format(_bounded_format(key, 64))
+            elif expected[key] != returned[key]:
+                diff = "key {0}: {1} != {2}".format(_bounded_format(key, 64),
+                                                    _bounded_format(expected[key], 64),
+                                                    _bounded_format(returned[key], 64))
+            else:
+                continue
+            count += 1
+            if len(diffs) < max_items:
+                diffs.append(diff)
+        for key in returned:
+            if key not in expected:
+                count += 1
+                if len(diffs) < max_items:
+                    diffs.append("unexpected key {0}".format(_bounded_format(key, 64)))
+    elif isinstance(expected, (list, tuple)) and isinstance(returned, (list, tuple)):
+        for index, (exp, ret) in enumerate(zip(expected, returned)):
+            if exp != ret:
+                count += 1
+                if len(diffs) < max_items:
+                    diffs.append("index {0}: {1} != {2}".format(index, _bounded_format(exp, 64),
+                                                               _bounded_format(ret, 64)))
+        if len(expected) != len(returned):
+            count += 1
+            if len(diffs) < max_items:
+                diffs.append("length {0} != {1}".format(len(expected), len(returned)))
+    else:
+        return None
+    return "{0} difference(s), first {1}: {2}".format(count, len(diffs), '; '.join(diffs))
+
+
+def _not_equal_message(expected, returned):
+    '''failure message of assertEqual, a structural diff for dicts and lists'''
+    diff = _structural_diff(expected, returned)
+    if diff is not None:
+        return diff
+    return "{0} is not equal to {1}".format(_bounded_format(expected), _bounded_format(returned))
+
+
+class PhaseTimer(object):
+    '''
+    Accumulates the wall clock time spent in each phase of a run: compile,
+    sync, discovery, render, validation, execution and assertion
+
+    Tests running concurrently each add their own time, so with parallel > 1
+    the validation, execution and assertion totals can exceed the run time
+    '''
+
+    def __init__(self):
+        self.totals = {}
+        self._lock = threading.Lock()
+
+    def add(self, name, seconds):
+        '''add seconds to the total of a phase'''
+        with self._lock:
+            self.totals[name] = self.totals.get(name, 0.0) + seconds
+
+    @contextmanager
+    def phase(self, name):
+        '''time the body of a with statement as a phase'''
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.add(name, time.time() - start)
+
+
+class TestTimeout(Exception):
+    '''
+    Raised when the module call of a test does not return within its timeout
+    '''
+
+
+class TestStatus(object):
+    '''
+    Outcome of a saltcheck test, the value is its legacy string prefix
+
+    The statuses are the TestStatus.PASS, FAIL, ERROR, SKIP and TIMEOUT
+    singletons, compared by identity
+    '''
+    __slots__ = ('value',)
+
+    def __init__(self, value):
+        self.value = value
+
+    def __repr__(self):
+        return "TestStatus({0!r})".format(self.value)
+
+
+TestStatus.PASS = TestStatus('Pass')
+TestStatus.FAIL = TestStatus('Fail')
+TestStatus.ERROR = TestStatus('Error')
+TestStatus.SKIP = TestStatus('Skip')
+TestStatus.TIMEOUT = TestStatus('Timeout')
+
+
+class TestResult(object):
+    '''
+    Compact record of the outcome of one test
+    '''
+    __slots__ = ('status', 'message', 'duration', 'timings')
+    MAX_MESSAGE_LENGTH = 1024
+
+    def __init__(self, status, message='', duration=None):
+        self.status = status
+        if len(message) > self.MAX_MESSAGE_LENGTH:
+            message = message[:self.MAX_MESSAGE_LENGTH - 3] + '...'
+        self.message = message
+        self.duration = duration
+        self.timings = None
+
+    def to_dict(self, timings=False):
+        '''return the structured output of the result'''
+        output = {'status': self.status.value, 'message': self.message, 'duration': self.duration}
+        if timings:
+            output['timings'] = self.timings or {}
+        return output
+
+    def to_legacy(self):
+        '''return the "Pass" / "Fail: ..." string of older saltcheck versions'''
+        if not self.message:
+            return self.status.value
+        return "{0}: {1}".format(self.status.value, self.message)
+
+    def __repr__(self):
+        return "TestResult({0}, {1!r}, {2})".format(self.status.value, self.message, self.duration)
+
+
+TestPlan = namedtuple('TestPlan', ['fun', 'function', 'args', 'kwargs', 'assertion', 'assert_func',
+                                   'cast_expected', 'expected', 'timeout', 'cache_key', 'parallel',
+                                   'skip', 'compile_time'])
+TestPlan.__doc__ = '''
+Immutable, validated form of a test, compiled once by SaltCheck.compile_test
+'''
+
+
+class RunSummary(object):
+    '''
+    Running totals of a run, fed one result at a time so that the results
+    themselves need not be kept to build the TEST RESULTS summary
+
+    With record, a (sls, test id, status, seconds) record of every test is
+    also kept in records, for the run history
+    '''
+
+    def __init__(self, slowest=10, record=False):
+        self.counts = Counter()
+        self.missing_tests = 0
+        self.passed = {}
+        self.slowest = slowest
+        self.slowest_tests = []
+        self.records = [] if record else None
+        self._state_counts = {}
+
+    def add(self, state, test_id, result):
+        '''record the result of one test of a state'''
+        self.counts[result.status] += 1
+        self._state_counts.setdefault(state, Counter())[result.status] += 1
+        if self.records is not None:
+            self.records.append((state, str(test_id), result.status.value, result.duration))
+        if result.duration is not None and self.slowest:
+            item = (result.duration, state, test_id)
+            if len(self.slowest_tests) < self.slowest:
+                heappush(self.slowest_tests, item)
+            elif item > self.slowest_tests[0]:
+                heapreplace(self.slowest_tests, item)
+
+    def end_state(self, state, missing=None):
+        '''
+        record that all tests of a state ran, return its {status: count}, a
+        state is missing tests when none ran unless missing says otherwise
+        '''
+        counts = self._state_counts.pop(state, Counter())
+        if missing is None:
+            missing = not counts
+        if missing:
+            self.missing_tests += 1
+        self.passed[state] = all(status is TestStatus.PASS for status in counts)
+        return dict((status.value, count) for status, count in counts.items())
+
+    def to_dict(self, scheck, unchanged=None, timings=False):
+        '''return the TEST RESULTS summary of the run'''
+        summary = {'Passed': self.counts[TestStatus.PASS],
+                   'Failed': self.counts[TestStatus.FAIL],
+                   'Errors': self.counts[TestStatus.ERROR],
+                   'Skipped': self.counts[TestStatus.SKIP],
+                   'Timed Out': self.counts[TestStatus.TIMEOUT],
+                   'Missing Tests': self.missing_tests,
+                   'Compile Time': scheck.timer.totals.get('compile'),
+                   'Function Index Build Time': scheck.function_index.build_time,
+                   'Call Cache Hit Ratio': scheck.call_cache.hit_ratio()}
+        if unchanged is not None:
+            summary['Unchanged'] = len(unchanged)
+            summary['Unchanged States'] = sorted(unchanged)
+        if timings:
+            summary['Timings'] = {
+                'Phases': dict(scheck.timer.totals),
+                'States': scheck.state_timings,
+                'Slowest Tests': [{'state': state, 'test': test_id, 'duration': duration}
+                                  for duration, state, test_id in sorted(self.slowest_tests, reverse=True)]}
+        return summary
+
+
+class TestSharding(object):
+    '''
+    Deterministic split of the tests of a run into shards, by a stable hash
+    of the sls and test id
+
+    Given {(sls, test id): seconds} durations, the tests of known duration are
+    dealt longest first to the least loaded shard instead, so shards finish at
+    about the same time. All shards must be given the same durations, their
+    fingerprint lets merge_results tell when they were not.
+    '''
+
+    def __init__(self, shard, shards, durations=None):
+        try:
+            self.shard = int(shard)
+            self.shards = int(shards)
+        except (TypeError, ValueError):
+            raise salt.exceptions.SaltInvocationError("shard and shards must be integers")
+        if self.shards < 1 or not 0 <= self.shard < self.shards:
+            raise salt.exceptions.SaltInvocationError(
+                "shard must be between 0 and shards - 1, got {0} of {1}".format(shard, shards))
+        self.assignment = self.balance(durations, self.shards) if durations else {}
+        self.fingerprint = None
+        if durations:
+            self.fingerprint = hashlib.sha1(dumps(sorted(
+                [sls, test_id, seconds] for (sls, test_id), seconds in durations.items()
+            )).encode('utf-8')).hexdigest()[:12]
+
+    @staticmethod
+    def stable_hash(*parts):
+        '''return a hash of the parts which is the same on every host and run'''
+        key = u'\0'.join(u'{0}'.format(part) for part in parts)
+        return int(hashlib.sha1(key.encode('utf-8')).hexdigest()[:8], 16)
+
+    @staticmethod
+    def balance(durations, shards):
+        '''return {(sls, test id): shard} dealing the longest tests first'''
+        shard_seconds = [0.0] * shards
+        assignment = {}
+        for key, seconds in sorted(durations.items(), key=lambda item: (-item[1], item[0])):
+            shard = shard_seconds.index(min(shard_seconds))
+            shard_seconds[shard] += seconds
+            assignment[key] = shard
+        return assignment
+
+    def shard_of(self, sls, test_id):
+        '''return the shard a test belongs to'''
+        shard = self.assignment.get((sls, str(test_id)))
+        if shard is None:
+            shard = self.stable_hash(sls, test_id) % self.shards
+        return shard
+
+    def select(self, sls, tests):
+        '''return the {test id: test} of a state belonging to this shard, in test order'''
+        return OrderedDict((key, value) for key, value in tests.items() if self.shard_of(sls, key) == self.shard)
+
+    def owns_state(self, sls):
+        '''whether this shard reports a state without tests as missing tests'''
+        return self.stable_hash(sls) % self.shards == self.shard
+
+
+class CallCache(object):
+    '''
+    Per run memo of module call results, keyed on the normalized function
+    name and arguments, so identical calls shared by many tests execute once
+
+    Concurrent callers of a key being computed wait for its result, up to
+    their own timeout. A call which timed out is not memoized, so the next
+    caller runs it again under its own timeout.
+    '''
+
+    def __init__(self):
+        self.entries = {}
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make_key(fun, args, kwargs):
+        '''normalize a call into a hashable key'''
+        return dumps([fun.strip(), list(args or []), kwargs or {}], sort_keys=True, default=repr)
+
+    def get_or_call(self, key, func, timeout=None, name='call'):
+        '''
+        return the memoized result of key, calling func on a miss, a caller
+        waiting on another caller's func gives up after timeout seconds
+        '''
+        with self._lock:
+            entry = self.entries.get(key)
+            owner = entry is None
+            if owner:
+                entry = self.entries[key] = {'done': threading.Event()}
+                self.misses += 1
+            else:
+                self.hits += 1
+        if owner:
+            try:
+                entry['value'] = func()
+            except TestTimeout:
+                raise
+            except Exception as err:  # pylint: disable=broad-except
+                entry['error'] = err
+            finally:
+                # timed out or interrupted, the call is not memoized
+                if 'value' not in entry and 'error' not in entry:
+                    with self._lock:
+                        self.entries.pop(key, None)
+                    entry['retry'] = True
+                entry['done'].set()
+        elif not entry['done'].wait(timeout):
+            raise TestTimeout("{0} did not return within {1} seconds".format(name, timeout))
+        if entry.get('retry'):
+            return func()
+        if 'error' in entry:
+            raise entry['error']
+        return entry['value']
+
+    def hit_ratio(self):
+        '''return the share of calls answered from the memo'''
+        total = self.hits + self.misses
+        return float(self.hits) / total if total else 0.0
+
+
+class FunctionIndex(object):
+    '''
+    In memory index of the modules and functions known to the minion loader
+
+    Built with one sys.list_functions call, instead of one sys.list_modules
+    and one sys.list_functions call per test
+    '''
+
+    def __init__(self):
+        self.modules = set()
+        self.functions = set()
+        self.build_time = None
+        self.built = False
+
+    def build(self):
+        '''list every loaded function once and index it'''
+        start = time.time()
+        try:
+            functions = __salt__['sys.list_functions']()
+        except salt.exceptions.SaltException:
+            functions = []
+        self.functions = set(functions)
+        self.modules = set(fun.split('.', 1)[0] for fun in self.functions)
+        self.build_time = time.time() - start
+        self.built = True
+        log.info("function index built in {}s: {} modules, {} functions".format(
+            self.build_time, len(self.modules), len(self.functions)))
+        return self
+
+    def invalidate(self):
+        '''drop the index, it is rebuilt on the next lookup'''
+        self.modules = set()
+        self.functions = set()
+        self.built = False
+
+    def has_module(self, module):
+        '''Determine if a module is loaded'''
+        if not self.built:
+            self.build()
+        return module in self.modules
+
+    def has_function(self, module, function):
+        '''Determine if a function is valid for a module'''
+        if not self.built:
+            self.build()
+        return "{0}.{1}".format(module, function) in self.functions
 
 
 class SaltCheck(object):
     '''
     This class implements the saltcheck
     '''
+    _assertion_table = None
 
-    def __init__(self):
+    def __init__(self, executor=None, timeout=None, legacy_output=None, sync=True):
         # self.sls_list_top = []
         self.sls_list_state = []
         self.modules = []
         self.results_dict = {}
         self.results_dict_summary = {}
-        self.assertions_list = '''assertEqual assertNotEqual
-                                  assertTrue assertFalse
-                                  assertIn assertNotIn
-                                  assertGreater
-                                  assertGreaterEqual
-                                  assertLess assertLessEqual
-                                  assertEmpty assertNotEmpty'''.split()
-        self.auto_update_master_cache = _get_auto_update_cache_value
-        # self.salt_lc = salt.client.Caller(mopts=__opts__)
-        self.salt_lc = salt.client.Caller()
-        if self.auto_update_master_cache:
-            update_master_cache()
-
-    def __is_valid_test(self, test_dict):
-        '''Determine if a test contains:
-             a test name,
-             a valid module and function,
-             a valid assertion,
-             an expected return value - if assertion type requires it'''
-        # 6 points needed for standard test
-        # 4 points needed for test with assertion not requiring expected return
-        tots = 0  
+        self.assertions_list = sorted(self.get_assertion_table())
+        self.function_index = FunctionIndex()
+        self.call_cache = CallCache()
+        self.timer = PhaseTimer()
+        self.state_timings = {}
+        self.timeout = timeout
+        if legacy_output is None:
+            legacy_output = __salt__['config.get']('saltcheck_legacy_output', False)
+        self.legacy_output = legacy_output
+        self.auto_update_master_cache = _get_auto_update_cache_value()
+        executor = executor or _get_executor_value()
+        if executor not in EXECUTORS:
+            raise salt.exceptions.SaltInvocationError(
+                "saltcheck executor must be one of {0}, not {1}".format(sorted(EXECUTORS), executor))
+        self.executor = EXECUTORS[executor]()
+        # the incremental sync is left to the StateTestLoader, which only
+        # fetches the saltcheck-tests of the states run
+        if self.auto_update_master_cache and self.auto_update_master_cache != 'incremental' and sync:
+            with self.timer.phase('sync'):
+                update_master_cache()
+
+    @classmethod
+    def get_assertion_table(cls):
+        '''
+        return {assertion: (function(expected, returned), needs expected-return,
+        expected cast to the returned type)}
+        '''
+        if cls._assertion_table is None:
+            cls._assertion_table = {
+                'assertEqual': (cls.__assert_equal, True, True),
+                'assertNotEqual': (cls.__assert_not_equal, True, True),
+                'assertTrue': (lambda expected, returned: cls.__assert_true(returned), False, False),
+                'assertFalse': (lambda expected, returned: cls.__assert_false(returned), False, False),
+                'assertIn': (cls.__assert_in, True, False),
+                'assertNotIn': (cls.__assert_not_in, True, False),
+                'assertGreater': (cls.__assert_greater, True, True),
+                'assertGreaterEqual': (cls.__assert_greater_equal, True, True),
+                'assertLess': (cls.__assert_less, True, True),
+                'assertLessEqual': (cls.__assert_less_equal, True, True),
+                'assertEmpty': (lambda expected, returned: cls.__assert_empty(returned), False, False),
+                'assertNotEmpty': (lambda expected, returned: cls.__assert_not_empty(returned), False, False),
+            }
+        return cls._assertion_table
+
+    def compile_test(self, test_dict):
+        '''
+        Validate a test and compile it into a TestPlan
+        Raises SaltInvocationError naming the problem for an invalid test
+        '''
+        if not isinstance(test_dict, dict):
+            raise salt.exceptions.SaltInvocationError("test must be a dictionary")
+        parallel = test_dict.get('parallel', True) is not False
+        if test_dict.get('skip', False):
+            return TestPlan(None, None, (), {}, None, None, False, None, None, None, parallel, True, 0.0)
         m_and_f = test_dict.get('module_and_function', None)
+        if not m_and_f or not isinstance(m_and_f, string_types) or m_and_f.count('.') != 1:
+            raise salt.exceptions.SaltInvocationError(
+                "module_and_function must be module.function, not {0}".format(m_and_f))
+        module, function = m_and_f.split('.')
+        if not self.function_index.has_module(module):
+            raise salt.exceptions.SaltInvocationError("module {0} is not available".format(module))
+        if not self.function_index.has_function(module, function):
+            raise salt.exceptions.SaltInvocationError("function {0} is not available".format(m_and_f))
         assertion = test_dict.get('assertion', None)
-        exp_ret_key = 'expected-return' in test_dict.keys()
-        exp_ret_val = test_dict.get('expected-return', None)
-        log.info("__is_valid_test has test: {}".format(test_dict))
-        if assertion in ["assertEmpty",
-                         "assertNotEmpty",
-                         "assertTrue",
-                         "assertFalse"]:
-            required_total = 4
-        else:
-            required_total = 6
- 
-        if m_and_f:
-            tots += 1
-            module, function = m_and_f.split('.')
-            if _is_valid_module(module):
-                tots += 1
-            if _is_valid_function(module, function):
-                tots += 1
-            log.info("__is_valid_test has valid m_and_f")
-        if assertion in self.assertions_list:
-            log.info("__is_valid_test has valid_assertion")
-            tots += 1
-
-        if exp_ret_key:
-            tots += 1
-            
-        if exp_ret_val != None:
-                tots += 1
-
-        # log the test score for debug purposes
-        log.info("__test score: {}".format(tots))
-        return tots >= required_total
+        if assertion not in self.get_assertion_table():
+            raise salt.exceptions.SaltInvocationError("unknown assertion {0}".format(assertion))
+        assert_func, needs_expected, cast_expected = self.get_assertion_table()[assertion]
+        expected = test_dict.get('expected-return', None)
+        if needs_expected and expected is None:
+            raise salt.exceptions.SaltInvocationError("{0} requires an expected-return".format(assertion))
+        timeout = test_dict.get('timeout', self.timeout)
+        try:
+            timeout = float(timeout) if timeout else None
+        except (TypeError, ValueError):
+            raise salt.exceptions.SaltInvocationError("invalid timeout {0}".format(timeout))
+        args = test_dict.get('args', None) or ()
+        if not isinstance(args, (list, tuple)):
+            args = [args]
+        kwargs = test_dict.get('kwargs', None) or {}
+        if not isinstance(kwargs, dict):
+            raise salt.exceptions.SaltInvocationError("kwargs must be a dictionary")
+        args = tuple(args)
+        kwargs = dict(kwargs)
+        cache_key = None
+        if test_dict.get('cache', True) is not False:
+            cache_key = CallCache.make_key(m_and_f, args, kwargs)
+        return TestPlan(m_and_f, self.executor.resolve(m_and_f), args, kwargs, assertion, assert_func,
+                        cast_expected, expected, timeout, cache_key, parallel, False, 0.0)
+
+    def compile_tests(self, tests):
+        '''
+        Compile a dict of {test id: test} into an OrderedDict of
+        {test id: TestPlan}, invalid tests map to their error TestResult
+        '''
+        plans = OrderedDict()
+        for key, test_dict in tests.items():
+            start = time.time()
+            try:
+                plan = self.compile_test(test_dict)
+                plans[key] = plan._replace(compile_time=time.time() - start)
+            except salt.exceptions.SaltInvocationError as err:
+                log.info("invalid test {}: {}".format(key, err))
+                elapsed = time.time() - start
+                plans[key] = TestResult(TestStatus.ERROR, "invalid test: {0}".format(err), duration=elapsed)
+                plans[key].timings = {'validation': elapsed}
+                self.timer.add('validation', elapsed)
+        return plans
+
+    def format_result(self, result, timings=False):
+        '''return the output form of a TestResult, legacy string or dict'''
+        return result.to_legacy() if self.legacy_output else result.to_dict(timings=timings)
+
+    def invalidate_function_index(self):
+        '''Forget the loader index, e.g. after saltutil.sync_modules'''
+        self.function_index.invalidate()
 
     def call_salt_command(self,
                           fun,
                           args,
-                          kwargs):
-        '''Generic call of salt Caller command'''
-        value = False
+                          kwargs,
+                          timeout=None):
+        '''
+        Generic call of a salt command through the execution backend
+
+        With a timeout the command runs on a daemon watchdog thread, which is
+        abandoned and a TestTimeout raised once the timeout expires
+        '''
+        return self.call_function(fun, self.executor.resolve(fun), args, kwargs, timeout=timeout)
+
+    @staticmethod
+    def call_function(fun, function, args, kwargs, timeout=None):
+        '''call a resolved salt function, under a watchdog when timeout is set'''
+        if not timeout:
+            return function(*(args or ()), **(kwargs or {}))
+        outcome = {}
+
+        def _target():
+            try:
+                outcome['value'] = function(*(args or ()), **(kwargs or {}))
+            except Exception as err:  # pylint: disable=broad-except
+                outcome['error'] = err
+
+        worker = threading.Thread(target=_target, name='saltcheck-{0}'.format(fun))
+        worker.daemon = True
+        worker.start()
+        worker.join(timeout)
+        if worker.is_alive():
+            raise TestTimeout(
+                "{0} did not return within {1} seconds".format(fun, timeout))
+        if 'error' in outcome:
+            raise outcome['error']
+        return outcome['value']
+
+    def run_tests(self, tests, parallel=1):
+        '''
+        Run a dict of {test id: test} and return an OrderedDict of results
+        in the order of the tests
+
+        All tests are compiled first, then up to parallel plans run at a time
+        on a thread pool, tests containing "parallel: False" are run one by one
+        once the pool is done
+        '''
+        return self.run_plans(self.compile_tests(tests), parallel=parallel)
+
+    def run_plans(self, plans, parallel=1):
+        '''Run an OrderedDict of {test id: TestPlan} as compiled by compile_tests'''
+        results = OrderedDict((key, None) for key in plans)
+        for key, value in self.iter_plans(plans, parallel=parallel):
+            results[key] = value
+        return results
+
+    def iter_plans(self, plans, parallel=1):
+        '''
+        Run an OrderedDict of {test id: TestPlan}, or any iterable of (test id,
+        TestPlan) pairs, yielding (test id, result) as each test completes, in
+        test order when parallel is 1
+
+        At most parallel tests are in flight, so pairs are only taken from
+        the iterable as tests complete. Tests with "parallel: False" run on
+        their own once all others completed.
+        '''
+        if isinstance(plans, dict):
+            plans = plans.items()
+        parallel = int(parallel or 1)
+        if parallel <= 1:
+            for key, plan in plans:
+                yield key, plan if isinstance(plan, TestResult) else self.run_plan(plan)
+            return
+        serial = []
+        pool = None
+        done = queue.Queue()
+        in_flight = 0
         try:
-            if args and kwargs:
-                value = self.salt_lc.cmd(fun, *args, **kwargs)
-            elif args and not kwargs:
-                value = self.salt_lc.cmd(fun, *args)
-            elif not args and kwargs:
-                value = self.salt_lc.cmd(fun, **kwargs)
-            else:
-                value = self.salt_lc.cmd(fun)
-        except salt.exceptions.SaltException:
-            raise
-        except Exception:
-            raise
-        return value
+            for key, plan in plans:
+                if isinstance(plan, TestResult):
+                    yield key, plan
+                    continue
+                if not plan.parallel:
+                    serial.append((key, plan))
+                    continue
+                if pool is None:
+                    pool = ThreadPool(parallel)
+                if in_flight >= parallel:
+                    yield done.get()
+                    in_flight -= 1
+                pool.apply_async(self.run_plan, (plan,), callback=partial(self.__put_result, done, key))
+                in_flight += 1
+            while in_flight:
+                yield done.get()
+                in_flight -= 1
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+        for key, plan in serial:
+            yield key, self.run_plan(plan)
+
+    @staticmethod
+    def __put_result(done, key, result):
+        '''queue the (test id, result) of a test run on the pool'''
+        done.put((key, result))
 
     def run_test(self, test_dict):
-        '''Run a single saltcheck test'''
-        if self.__is_valid_test(test_dict):
-            mod_and_func = test_dict['module_and_function']
-            args = test_dict.get('args', None)
-            kwargs = test_dict.get('kwargs', None)
-            assertion = test_dict['assertion']
-            expected_return = test_dict.get('expected-return', None)
-            actual_return = self.call_salt_command(mod_and_func, args, kwargs)
-            if assertion not in ["assertIn", "assertNotIn", "assertEmpty", "assertNotEmpty",
-                                 "assertTrue", "assertFalse"]:
-                expected_return = self.cast_expected_to_returned_type(expected_return, actual_return)
-            if assertion == "assertEqual":
-                value = self.__assert_equal(expected_return, actual_return)
-            elif assertion == "assertNotEqual":
-                value = self.__assert_not_equal(expected_return, actual_return)
-            elif assertion == "assertTrue":
-                value = self.__assert_true(actual_return)
-            elif assertion == "assertFalse":
-                value = self.__assert_false(actual_return)
-            elif assertion == "assertIn":
-                value = self.__assert_in(expected_return, actual_return)
-            elif assertion == "assertNotIn":
-                value = self.__assert_not_in(expected_return, actual_return)
-            elif assertion == "assertGreater":
-                value = self.__assert_greater(expected_return, actual_return)
-            elif assertion == "assertGreaterEqual":
-                value = self.__assert_greater_equal(expected_return, actual_return)
-            elif assertion == "assertLess":
-                value = self.__assert_less(expected_return, actual_return)
-            elif assertion == "assertLessEqual":
-                value = self.__assert_less_equal(expected_return, actual_return)
-            elif assertion == "assertEmpty":
-                value = self.__assert_empty(actual_return)
-            elif assertion == "assertNotEmpty":
-                value = self.__assert_not_empty(actual_return)
+        '''Run a single saltcheck test and return its TestResult'''
+        return self.run_tests({None: test_dict})[None]
+
+    def run_plan(self, plan):
+        '''Execute a TestPlan and return its TestResult'''
+        start = time.time()
+        timings = {'validation': plan.compile_time}
+        try:
+            result = self.__run_plan(plan, timings)
+        except Exception as err:  # pylint: disable=broad-except
+            log.info("test raised an exception: {}".format(err))
+            result = TestResult(TestStatus.ERROR, "{0}: {1}".format(type(err).__name__, err))
+        result.duration = time.time() - start + plan.compile_time
+        if 'execution' in timings:
+            timings['assertion'] = result.duration - timings['validation'] - timings['execution']
+        result.timings = timings
+        for name, seconds in timings.items():
+            self.timer.add(name, seconds)
+        return result
+
+    def __run_plan(self, plan, timings):
+        '''call and assert a single plan, filling in timings'''
+        if plan.skip:
+            return TestResult(TestStatus.SKIP, "skipped")
+        start = time.time()
+        try:
+            if plan.cache_key is None:
+                actual_return = self.call_function(plan.fun, plan.function, plan.args, plan.kwargs,
+                                                   timeout=plan.timeout)
             else:
-                value = "Fail - bas assertion"
-        else:
-            return "Fail - invalid test"
-        return value
+                actual_return = self.call_cache.get_or_call(
+                    plan.cache_key,
+                    lambda: self.call_function(plan.fun, plan.function, plan.args, plan.kwargs,
+                                               timeout=plan.timeout),
+                    timeout=plan.timeout, name=plan.fun)
+        except TestTimeout as err:
+            return TestResult(TestStatus.TIMEOUT, str(err))
+        finally:
+            timings['execution'] = time.time() - start
+        expected_return = plan.expected
+        if plan.cast_expected and type(expected_return) is not type(actual_return):
+            expected_return = self.cast_expected_to_returned_type(expected_return, actual_return)
+        return plan.assert_func(expected_return, actual_return)
 
     @staticmethod
     def cast_expected_to_returned_type(expected, returned):
@@ -429,12 +1905,12 @@ class SaltCheck(object):
         '''
         Test if two objects are equal
         '''
-        result = "Pass"
+        result = TestResult(TestStatus.PASS)
 
         try:
-            assert (expected == returned), "{0} is not equal to {1}".format(expected, returned)
+            assert (expected == returned), _not_equal_message(expected, returned)
         except AssertionError as err:
-            result = "Fail: " + str(err)
+            result = TestResult(TestStatus.FAIL, str(err))
         return result
 
     @staticmethod
@@ -442,11 +1918,12 @@ class SaltCheck(object):
         '''
         Test if two objects are not equal
         '''
-        result = "Pass"
+        result = TestResult(TestStatus.PASS)
         try:
-            assert (expected != returned), "{0} is equal to {1}".format(expected, returned)
+            assert (expected != returned), "{0} is equal to {1}".format(_bounded_format(expected),
+                                                                          _bounded_format(returned))
         except AssertionError as err:
-            result = "Fail: " + str(err)
+            result = TestResult(TestStatus.FAIL, str(err))
         return result
 
     @staticmethod
@@ -454,11 +1931,11 @@ class SaltCheck(object):
         '''
         Test if an boolean is True
         '''
-        result = "Pass"
+        result = TestResult(TestStatus.PASS)
         try:
-            assert (returned is True), "{0} not True".format(returned)
+            assert (returned is True), "{0} not True".format(_bounded_format(returned))
         except AssertionError as err:
-            result = "Fail: " + str(err)
+            result = TestResult(TestStatus.FAIL, str(err))
         return result
 
     @staticmethod
@@ -466,16 +1943,16 @@ class SaltCheck(object):
         '''
         Test if an boolean is False
         '''
-        result = "Pass"
+        result = TestResult(TestStatus.PASS)
         if isinstance(returned, str):
             try:
                 returned = bool(returned)
             except ValueError:
                 raise
         try:
-            assert (returned is False), "{0} not False".format(returned)
+            assert (returned is False), "{0} not False".format(_bounded_format(returned))
         except AssertionError as err:
-            result = "Fail: " + str(err)
+            result = TestResult(TestStatus.FAIL, str(err))
         return result
 
     @staticmethod
@@ -483,11 +1960,12 @@ class SaltCheck(object):
         '''
         Test if a value is in the list of returned values
         '''
-        result = "Pass"
+        result = TestResult(TestStatus.PASS)
         try:
-            assert (expected in returned), "{0} not False".format(returned)
+            assert (expected in returned), "{0} not in {1}".format(_bounded_format(expected),
+                                                                  _bounded_format(returned))
         except AssertionError as err:
-            result = "Fail: " + str(err)
+            result = TestResult(TestStatus.FAIL, str(err))
         return result
 
     @staticmethod
@@ -495,11 +1973,12 @@ class SaltCheck(object):
         '''
         Test if a value is not in the list of returned values
         '''
-        result = "Pass"
+        result = TestResult(TestStatus.PASS)
         try:
-            assert (expected not in returned), "{0} not False".format(returned)
+            assert (expected not in returned), "{0} in {1}".format(_bounded_format(expected),
+                                                                  _bounded_format(returned))
         except AssertionError as err:
-            result = "Fail: " + str(err)
+            result = TestResult(TestStatus.FAIL, str(err))
         return result
 
     @staticmethod
@@ -507,11 +1986,12 @@ class SaltCheck(object):
         '''
         Test if a value is greater than the returned value
         '''
-        result = "Pass"
+        result = TestResult(TestStatus.PASS)
         try:
-            assert (expected > returned), "{0} not False".format(returned)
+            assert (expected > returned), "{0} not greater than {1}".format(_bounded_format(expected),
+                                                                           _bounded_format(returned))
         except AssertionError as err:
-            result = "Fail: " + str(err)
+            result = TestResult(TestStatus.FAIL, str(err))
         return result
 
     @staticmethod
@@ -519,11 +1999,12 @@ class SaltCheck(object):
         '''
         Test if a value is greater than or equal to the returned value
         '''
-        result = "Pass"
+        result = TestResult(TestStatus.PASS)
         try:
-            assert (expected >= returned), "{0} not False".format(returned)
+            assert (expected >= returned), "{0} not greater than or equal to {1}".format(
+                _bounded_format(expected), _bounded_format(returned))
         except AssertionError as err:
-            result = "Fail: " + str(err)
+            result = TestResult(TestStatus.FAIL, str(err))
         return result
 
     @staticmethod
@@ -531,11 +2012,12 @@ class SaltCheck(object):
         '''
         Test if a value is less than the returned value
         '''
-        result = "Pass"
+        result = TestResult(TestStatus.PASS)
         try:
-            assert (expected < returned), "{0} not False".format(returned)
+            assert (expected < returned), "{0} not less than {1}".format(_bounded_format(expected),
+                                                                        _bounded_format(returned))
         except AssertionError as err:
-            result = "Fail: " + str(err)
+            result = TestResult(TestStatus.FAIL, str(err))
         return result
 
     @staticmethod
@@ -543,11 +2025,12 @@ class SaltCheck(object):
         '''
         Test if a value is less than or equal to the returned value
         '''
-        result = "Pass"
+        result = TestResult(TestStatus.PASS)
         try:
-            assert (expected <= returned), "{0} not False".format(returned)
+            assert (expected <= returned), "{0} not less than or equal to {1}".format(
+                _bounded_format(expected), _bounded_format(returned))
         except AssertionError as err:
-            result = "Fail: " + str(err)
+            result = TestResult(TestStatus.FAIL, str(err))
         return result
 
     @staticmethod
@@ -555,11 +2038,11 @@ class SaltCheck(object):
         '''
         Test if a returned value is empty
         '''
-        result = "Pass"
+        result = TestResult(TestStatus.PASS)
         try:
-            assert (not returned), "{0} is not empty".format(returned)
+            assert (not returned), "{0} is not empty".format(_bounded_format(returned))
         except AssertionError as err:
-            result = "Fail: " + str(err)
+            result = TestResult(TestStatus.FAIL, str(err))
         return result
 
     @staticmethod
@@ -567,11 +2050,11 @@ class SaltCheck(object):
         '''
         Test if a returned value is not empty
         '''
-        result = "Pass"
+        result = TestResult(TestStatus.PASS)
         try:
-            assert (returned), "{0} is empty".format(returned)
+            assert (returned), "{0} is empty".format(_bounded_format(returned))
         except AssertionError as err:
-            result = "Fail: " + str(err)
+            result = TestResult(TestStatus.FAIL, str(err))
         return result
 
 
@@ -580,15 +2063,400 @@ class SaltCheck(object):
         '''For the state file system, return a
            list of paths to search for states'''
         # state cache should be updated before running this method
-        search_list = []
-        cachedir = __opts__.get('cachedir', None)
-        environment = __opts__['environment']
-        if environment:
-            path = cachedir + os.sep + "files" + os.sep + environment
-            search_list.append(path)
-        path = cachedir + os.sep + "files" + os.sep + "base"
-        search_list.append(path)
-        return search_list
+        return [_get_cache_root(saltenv) for saltenv in _get_saltenvs()]
+
+
+class RenderCache(object):
+    '''
+    On disk cache of rendered and normalized test files in the minion cachedir
+
+    Entries are keyed on the file path and content, the renderer and a
+    fingerprint of the grains and pillar values the template reads. Templates
+    reading any other name of the render context (opts, saltenv, tpldir...),
+    calling other salt functions, pulling in other files or loading data with
+    the import_* and load_* tags are never cached. The least recently used
+    entries are evicted once max_entries is exceeded.
+    '''
+    JINJA_RE = re.compile(r'{{.*?}}|{%.*?%}', re.S)
+    LOOKUP_RE = re.compile(
+        r'''\b(grains|pillar)\s*(?:\[\s*|\.get\(\s*)['"]([^'"]+)['"]'''
+        r'''|\bsalt\s*\[\s*['"](grains|pillar)\.(?:get|item)['"]\s*\]\s*\(\s*['"]([^'"]+)['"]''')
+    NAME_RE = re.compile(r'\b(grains|pillar|salt)\b')
+    CONTEXT_RE = re.compile(r'\b(opts|saltenv|env|sls|sls_path|slspath|slsdotpath|slscolonpath|tplpath|'
+                            r'tplfile|tpldir|tpldot|tplroot|proxy|show_full_context|__\w+__)\b')
+    UNCACHEABLE_RE = re.compile(r'^{%-?\s*(include|import|from|extends|import_\w+|load_\w+)\b')
+
+    def __init__(self, max_entries=1000):
+        self.cache_dir = os.path.join(__opts__['cachedir'], 'saltcheck', 'rendered')
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._entries = None
+
+    def fingerprint(self, contents):
+        '''
+        return a fingerprint of the grains and pillar values read by the jinja
+        of a template, or None if its rendering depends on more than those
+        '''
+        if contents.startswith('#!') and not all(
+                part.strip() in ('jinja', 'yaml') for part in contents[2:].splitlines()[0].split('|')):
+            return None
+        blocks = self.JINJA_RE.findall(contents)
+        if any(self.UNCACHEABLE_RE.match(block) for block in blocks):
+            return None
+        jinja = '\n'.join(blocks)
+        if self.CONTEXT_RE.search(jinja):
+            return None
+        lookups = []
+        for match in self.LOOKUP_RE.finditer(jinja):
+            if match.group(1):
+                lookups.append((match.group(1), match.group(2), False))
+            else:
+                lookups.append((match.group(3), match.group(4), True))
+        names = self.NAME_RE.findall(jinja)
+        if names.count('salt') > sum(1 for lookup in lookups if lookup[2]):
+            # some other salt function is called
+            return None
+        values = []
+        for source in ('grains', 'pillar'):
+            keys = sorted(set(key for src, key, dummy in lookups if src == source))
+            if names.count(source) > sum(1 for lookup in lookups if lookup[0] == source):
+                # used in some other way than a key lookup, fingerprint all of it
+                values.append([source, __grains__ if source == 'grains' else __pillar__])
+            else:
+                for key in keys:
+                    values.append([source, key, __salt__['{0}.get'.format(source)](key)])
+        return hashlib.sha256(dumps(values, sort_keys=True, default=repr).encode('utf-8')).hexdigest()
+
+    def make_key(self, filepath):
+        '''return the cache key of a test file, None if it cannot be cached'''
+        with open(filepath, 'rb') as myfile:
+            raw = myfile.read()
+        fingerprint = self.fingerprint(raw.decode('utf-8', 'replace'))
+        if fingerprint is None:
+            return None
+        hasher = hashlib.sha256(raw)
+        hasher.update(os.path.abspath(filepath).encode('utf-8'))
+        hasher.update(str(__opts__.get('renderer', 'yaml_jinja')).encode('utf-8'))
+        hasher.update(fingerprint.encode('utf-8'))
+        return hasher.hexdigest()
+
+    def load(self, filepath, render):
+        '''return the cached tests of a file, or render and cache them'''
+        key = self.make_key(filepath)
+        if key is None:
+            return render(filepath)
+        entry_path = os.path.join(self.cache_dir, key + '.json')
+        try:
+            with open(entry_path, 'r') as myfile:
+                tests = loads(myfile.read())
+            os.utime(entry_path, None)
+            self.hits += 1
+            return tests
+        except (IOError, OSError, ValueError):
+            pass
+        self.misses += 1
+        tests = render(filepath)
+        self.store(entry_path, tests)
+        return tests
+
+    def store(self, entry_path, tests):
+        '''write a cache entry, evicting the least recently used when full'''
+        if not os.path.isdir(self.cache_dir):
+            os.makedirs(self.cache_dir)
+        if self._entries is None:
+            self._entries = len(os.listdir(self.cache_dir))
+        tmp_path = '{0}.{1}.tmp'.format(entry_path, threading.current_thread().ident)
+        with open(tmp_path, 'w') as myfile:
+            myfile.write(dumps(tests))
+        os.rename(tmp_path, entry_path)
+        self._entries += 1
+        if self._entries > self.max_entries:
+            self.evict()
+
+    def evict(self):
+        '''drop the least recently used entries down to 90% of max_entries'''
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            entry_path = os.path.join(self.cache_dir, name)
+            try:
+                entries.append((os.path.getmtime(entry_path), entry_path))
+            except OSError:
+                continue
+        entries.sort()
+        keep = max(int(self.max_entries * 0.9), 1)
+        for dummy, entry_path in entries[:max(len(entries) - keep, 0)]:
+            try:
+                os.remove(entry_path)
+            except OSError:
+                pass
+        self._entries = min(len(entries), keep)
+
+
+class DiscoveryIndex(object):
+    '''
+    Persisted inverted index of {sls path: [.tst files]} for one search path
+
+    Every directory of the tree is recorded with its mtime, so a refresh only
+    stats directories and rescans the ones whose entries changed. When the
+    search path was just synced incrementally (synced) and the manifest did
+    not change since the last refresh, the directories are not even stat'ed.
+    '''
+
+    def __init__(self, root, synced=False):
+        self.root = os.path.abspath(root)
+        self.synced = synced
+        self.index_path = os.path.join(
+            __opts__['cachedir'], 'saltcheck',
+            'discovery-{0}.json'.format(hashlib.sha1(self.root.encode('utf-8')).hexdigest()[:16]))
+        self.dirs = {}   # relative dir: mtime, for every directory under root
+        self.children = {}  # relative dir: [sub directory names]
+        self.files = {}  # relative dir inside a saltcheck-tests tree: [.tst names]
+        self.tests = {}  # sls path: [.tst files]
+        self.stamp = None
+
+    def load(self):
+        '''load the persisted index and bring it up to date'''
+        try:
+            with open(self.index_path, 'r') as myfile:
+                data = loads(myfile.read())
+            if data.get('root') == self.root:
+                self.dirs, self.children, self.files, self.stamp = (
+                    data['dirs'], data['children'], data['files'], data['stamp'])
+        except (IOError, OSError, ValueError, KeyError):
+            log.info("no usable discovery index for {}, building it".format(self.root))
+        self.refresh()
+        return self
+
+    def save(self):
+        '''persist the index in the cachedir'''
+        index_dir = os.path.dirname(self.index_path)
+        if not os.path.isdir(index_dir):
+            os.makedirs(index_dir)
+        with open(self.index_path, 'w') as myfile:
+            myfile.write(dumps({'root': self.root, 'stamp': self.stamp, 'dirs': self.dirs,
+                                'children': self.children, 'files': self.files}))
+
+    def _manifest_stamp(self):
+        '''return the mtime and size of the sync manifest of root, if any'''
+        saltenv, dummy = _map_cache_path(self.root)
+        if saltenv is None:
+            return None
+        try:
+            stat = os.stat(_get_manifest_path(saltenv))
+        except OSError:
+            return None
+        return [stat.st_mtime, stat.st_size]
+
+    def refresh(self):
+        '''rescan the directories changed since the index was built'''
+        stamp = self._manifest_stamp()
+        # the manifest only tells about this tree when this run just synced it
+        if self.synced and stamp is not None and stamp == self.stamp and self.dirs:
+            self._build_tests()
+            return
+        changed = stamp != self.stamp
+        if not self.dirs:
+            changed = self._scan_dir('') or changed
+        else:
+            for reldir, mtime in list(self.dirs.items()):
+                if reldir not in self.dirs:
+                    continue  # dropped along with a removed parent
+                try:
+                    current = os.stat(os.path.join(self.root, reldir)).st_mtime
+                except OSError:
+                    self._drop(reldir)
+                    changed = True
+                    continue
+                if current != mtime:
+                    changed = self._scan_dir(reldir) or changed
+        self.stamp = stamp
+        self._build_tests()
+        if changed:
+            self.save()
+
+    def _scan_dir(self, reldir):
+        '''(re)index one directory, and the new sub directories below it'''
+        pending = [reldir]
+        while pending:
+            reldir = pending.pop()
+            full_path = os.path.join(self.root, reldir)
+            try:
+                mtime = os.stat(full_path).st_mtime
+                subdirs, tst_files = self._list_dir(full_path)
+            except OSError:
+                self._drop(reldir)
+                continue
+            self.dirs[reldir] = mtime
+            if 'saltcheck-tests' in reldir.split(os.sep):
+                self.files[reldir] = sorted(tst_files)
+            for name in set(self.children.get(reldir, [])) - set(subdirs):
+                self._drop(os.path.join(reldir, name) if reldir else name)
+            self.children[reldir] = sorted(subdirs)
+            for name in subdirs:
+                subdir = os.path.join(reldir, name) if reldir else name
+                if subdir not in self.dirs:
+                    pending.append(subdir)
+        return True
+
+    @staticmethod
+    def _list_dir(full_path):
+        '''return the sub directory names and .tst file names of a directory'''
+        subdirs = []
+        tst_files = []
+        if hasattr(os, 'scandir'):
+            # the dir entries know their type, no stat per entry
+            for entry in os.scandir(full_path):
+                if entry.is_dir():
+                    subdirs.append(entry.name)
+                elif entry.name.endswith('.tst'):
+                    tst_files.append(entry.name)
+            return subdirs, tst_files
+        for name in os.listdir(full_path):
+            if os.path.isdir(os.path.join(full_path, name)):
+                subdirs.append(name)
+            elif name.endswith('.tst'):
+                tst_files.append(name)
+        return subdirs, tst_files
+
+    def _drop(self, reldir):
+        '''forget a removed directory and everything below it'''
+        parent, name = os.path.split(reldir)
+        if name in self.children.get(parent, []):
+            self.children[parent].remove(name)
+        pending = [reldir]
+        while pending:
+            reldir = pending.pop()
+            self.dirs.pop(reldir, None)
+            self.files.pop(reldir, None)
+            pending.extend(os.path.join(reldir, child) for child in self.children.pop(reldir, []))
+
+    def _build_tests(self):
+        '''derive {sls path: [.tst files]} from the indexed directories'''
+        tests = {}
+        for reldir in sorted(self.files):
+            parts = reldir.split(os.sep)
+            sls_path = os.sep.join(parts[:parts.index('saltcheck-tests')])
+            tests.setdefault(sls_path, []).extend(
+                os.path.join(self.root, reldir, name) for name in self.files[reldir])
+        self.tests = tests
+
+    def lookup(self, sls_path):
+        '''return the .tst files of the saltcheck-tests dir of an sls path'''
+        return self.tests.get(sls_path.strip(os.sep), [])
+
+
+class ResultHistory(object):
+    '''
+    Sqlite store of the status and duration of the tests of past runs in the
+    minion cachedir
+
+    A run is appended in one transaction, which also prunes the runs older
+    than retention_days
+    '''
+    SCHEMA = (
+        'CREATE TABLE IF NOT EXISTS runs (id INTEGER PRIMARY KEY, started REAL NOT NULL, shard TEXT)',
+        'CREATE TABLE IF NOT EXISTS results (run INTEGER NOT NULL, state TEXT NOT NULL, '
+        'test TEXT NOT NULL, status TEXT NOT NULL, duration REAL)',
+        'CREATE INDEX IF NOT EXISTS runs_started ON runs (started)',
+        'CREATE INDEX IF NOT EXISTS results_run ON results (run)',
+        'CREATE INDEX IF NOT EXISTS results_test ON results (state, test)',
+    )
+
+    def __init__(self, retention_days=30):
+        self.path = os.path.join(__opts__['cachedir'], 'saltcheck', 'history.db')
+        self.retention_days = retention_days
+
+    def connect(self):
+        '''return a connection to the database, creating it if needed'''
+        if not os.path.isdir(os.path.dirname(self.path)):
+            os.makedirs(os.path.dirname(self.path))
+        conn = sqlite3.connect(self.path, timeout=30)
+        for statement in self.SCHEMA:
+            conn.execute(statement)
+        return conn
+
+    def record(self, records, shard=None):
+        '''append the (sls, test id, status, seconds) records of a run'''
+        if not records:
+            return
+        now = time.time()
+        try:
+            conn = self.connect()
+            try:
+                with conn:
+                    run = conn.execute('INSERT INTO runs (started, shard) VALUES (?, ?)', (now, shard)).lastrowid
+                    conn.executemany('INSERT INTO results (run, state, test, status, duration) '
+                                     'VALUES (?, ?, ?, ?, ?)',
+                                     ((run,) + tuple(record) for record in records))
+                    cutoff = now - self.retention_days * 86400
+                    conn.execute('DELETE FROM results WHERE run IN (SELECT id FROM runs WHERE started < ?)',
+                                 (cutoff,))
+                    conn.execute('DELETE FROM runs WHERE started < ?', (cutoff,))
+            finally:
+                conn.close()
+        except sqlite3.Error as err:
+            log.info("saltcheck could not record the run history: {0}".format(err))
+
+    def query(self, sql, params):
+        '''return the rows of a query, none when there is no history yet'''
+        if not os.path.isfile(self.path):
+            return []
+        conn = self.connect()
+        try:
+            return conn.execute(sql, params).fetchall()
+        finally:
+            conn.close()
+
+    @staticmethod
+    def _where(state, test, days):
+        '''return the WHERE clause and parameters selecting results'''
+        clauses = []
+        params = []
+        if state is not None:
+            clauses.append('results.state = ?')
+            params.append(state)
+        if test is not None:
+            clauses.append('results.test = ?')
+            params.append(str(test))
+        if days is not None:
+            clauses.append('runs.started >= ?')
+            params.append(time.time() - float(days) * 86400)
+        return (' WHERE ' + ' AND '.join(clauses)) if clauses else '', params
+
+    def history(self, state=None, test=None, limit=50):
+        '''return the most recent results, newest first'''
+        where, params = self._where(state, test, None)
+        rows = self.query('SELECT runs.started, runs.shard, results.state, results.test, results.status, '
+                          'results.duration FROM results JOIN runs ON runs.id = results.run' + where +
+                          ' ORDER BY runs.started DESC, results.rowid LIMIT ?', params + [int(limit)])
+        return [{'time': started, 'shard': shard, 'state': state_name, 'test': test_id,
+                 'status': status, 'duration': duration}
+                for started, shard, state_name, test_id, status, duration in rows]
+
+    def durations(self, days=None):
+        '''return the mean duration of every test as {sls: {test id: seconds}}'''
+        where, params = self._where(None, None, days)
+        rows = self.query('SELECT results.state, results.test, AVG(results.duration) '
+                          'FROM results JOIN runs ON runs.id = results.run' + where +
+                          ' GROUP BY results.state, results.test', params)
+        durations = {}
+        for state_name, test_id, seconds in rows:
+            if seconds is not None:
+                durations.setdefault(state_name, {})[test_id] = seconds
+        return durations
+
+    def slowest(self, state=None, days=None, limit=10):
+        '''return the tests with the longest mean duration, with their run and failure counts'''
+        where, params = self._where(state, None, days)
+        rows = self.query('SELECT results.state, results.test, COUNT(*), AVG(results.duration), '
+                          'MAX(results.duration), SUM(results.status != ?) '
+                          'FROM results JOIN runs ON runs.id = results.run' + where +
+                          ' GROUP BY results.state, results.test ORDER BY AVG(results.duration) DESC LIMIT ?',
+                          [TestStatus.PASS.value] + params + [int(limit)])
+        return [{'state': state_name, 'test': test_id, 'runs': runs, 'mean duration': mean,
+                 'max duration': longest, 'not passed': not_passed}
+                for state_name, test_id, runs, mean, longest, not_passed in rows]
 
 
 class StateTestLoader(object):
@@ -597,8 +2465,14 @@ class StateTestLoader(object):
     e.g.  state_dir/saltcheck-tests/[1.tst, 2.tst, 3.tst]
     '''
 
-    def __init__(self, search_paths):
+    def __init__(self, search_paths, refresh=True, render_cache=None, fast_yaml=True, timer=None):
         self.search_paths = search_paths
+        self.timer = timer or PhaseTimer()
+        self.refresh = refresh
+        self.render_cache = render_cache
+        self.fast_yaml = fast_yaml
+        self.synced = set()  # (saltenv, sls path) fetched in this run
+        self.discovery_indexes = {}
         self.path_type = None
         self.test_files = []  # list of file paths
         self.test_dict = {}
@@ -608,9 +2482,29 @@ class StateTestLoader(object):
         self.test_dict = {}
         for myfile in self.test_files:
             # self.load_file(myfile)
-            self.load_file_salt_rendered(myfile)
+            with self.timer.phase('render'):
+                self.load_file_salt_rendered(myfile)
         self.test_files = []
 
+    def iter_test_suite(self):
+        '''
+        load the test files one at a time, yielding ({test id: test}, path)
+        per file so that only the tests of one file are held at once
+
+        A test id already yielded by an earlier file is skipped, where
+        load_test_suite lets the last file win
+        '''
+        test_files, self.test_files = self.test_files, []
+        seen = set()
+        for myfile in test_files:
+            with self.timer.phase('render'):
+                tests = self.render_test_file(myfile)
+            for key in [key for key in tests if key in seen]:
+                log.info("duplicate test id {} in {} skipped".format(key, myfile))
+                del tests[key]
+            seen.update(tests)
+            yield tests, myfile
+
     def load_file(self, filepath):
         '''
         loads in one test file
@@ -619,7 +2513,7 @@ class StateTestLoader(object):
             with __utils__['files.fopen'](filepath, 'r') as myfile:
                 # with salt.utils.files.fopen(filepath, 'r') as myfile:
                 # with open(filepath, 'r') as myfile:
-                contents_yaml = yaml.load(myfile)
+                contents_yaml = yaml.load(myfile, Loader=YamlSafeLoader)
                 for key, value in contents_yaml.items():
                     self.test_dict[key] = value
         except:
@@ -630,32 +2524,58 @@ class StateTestLoader(object):
         '''
         loads in one test file
         '''
-        # use the salt renderer module to interpret jinja and etc
-        tests = _render_file(filepath)
-        # use json as a convenient way to convert the OrderedDicts from salt renderer
-        mydict = loads(dumps(tests))
-        for key, value in mydict.items():
+        for key, value in self.render_test_file(filepath).items():
             self.test_dict[key] = value
         return
 
-    def gather_files(self, filepath):
-        '''gather files for a test suite'''
-        self.test_files = []
-        log.info("gather_files: {}".format(time.time()))
-        filepath = filepath + os.sep + 'saltcheck-tests'
-
-        # clear out, and repopulate the saltcheck-tests for a state
-        _refresh_saltcheck_tests_dir(filepath)
-
-        rootdir = filepath
-        # for dirname, subdirlist, filelist in os.walk(rootdir):
-        for dirname, dummy, filelist in os.walk(rootdir):
-            for fname in filelist:
-                if fname.endswith('.tst'):
-                    start_path = dirname + os.sep + fname
-                    full_path = os.path.abspath(start_path)
-                    self.test_files.append(full_path)
-        return
+    def render_test_file(self, filepath):
+        '''return the {test id: test} of one test file'''
+        # plain yaml files skip the salt renderer entirely
+        mydict = _load_plain_yaml(filepath) if self.fast_yaml else None
+        if mydict is None and self.render_cache is not None:
+            mydict = self.render_cache.load(filepath, _render_file_normalized)
+        elif mydict is None:
+            mydict = _render_file_normalized(filepath)
+        return mydict
+
+    def sync(self, sls_paths):
+        '''
+        fetch the changed saltcheck-tests of the sls paths from the master,
+        with one batch per saltenv
+        '''
+        if not self.refresh:
+            return
+        for path in self.search_paths:
+            saltenv, dummy = _map_cache_path(path)
+            if saltenv is None:
+                log.info("path is not in the fileserver cache= {}".format(path))
+                continue
+            pending = sorted(set(sls_path for sls_path in sls_paths if (saltenv, sls_path) not in self.synced))
+            if pending:
+                with self.timer.phase('sync'):
+                    _sync_saltcheck_files(saltenv, pending)
+                self.synced.update((saltenv, sls_path) for sls_path in pending)
+                # reloaded on the next lookup, to see the files just fetched
+                self.discovery_indexes.pop(path, None)
+
+    def sync_sls_files(self, sls_list):
+        '''fetch the changed sls files of sls_list from the master'''
+        if not self.refresh:
+            return
+        for path in self.search_paths:
+            saltenv, dummy = _map_cache_path(path)
+            if saltenv is not None:
+                with self.timer.phase('sync'):
+                    _sync_sls_files(saltenv, sls_list)
+
+    def get_discovery_index(self, path):
+        '''return the up to date discovery index of a search path'''
+        index = self.discovery_indexes.get(path)
+        if index is None:
+            saltenv, dummy = _map_cache_path(path)
+            index = self.discovery_indexes[path] = DiscoveryIndex(
+                path, synced=any(synced[0] == saltenv for synced in self.synced)).load()
+        return index
 
     @staticmethod
     def convert_sls_to_paths(sls_list):
@@ -674,20 +2594,16 @@ class StateTestLoader(object):
 
     def add_test_files_for_sls(self, sls_path):
         '''Adding test files'''
+        self.sync([sls_path])
         for path in self.search_paths:
-            full_path = path + os.sep + sls_path
-            rootdir = full_path
-            if os.path.isdir(full_path):
-                log.info("searching path= {}".format(full_path))
-                # for dirname, subdirlist, filelist in os.walk(rootdir, topdown=True):
-                for dirname, subdirlist, dummy in os.walk(rootdir, topdown=True):
-                    if "saltcheck-tests" in subdirlist:
-                        self.gather_files(dirname)
-                        log.info("test_files list: {}".format(self.test_files))
-                        log.info("found subdir match in = {}".format(dirname))
-                    else:
-                        log.info("did not find subdir match in = {}".format(dirname))
-                    del subdirlist[:]
+            if not os.path.isdir(path):
+                log.info("path is not a directory= {}".format(path))
+                continue
+            with self.timer.phase('discovery'):
+                test_files = self.get_discovery_index(path).lookup(sls_path)
+            if test_files:
+                self.test_files = list(test_files)
+                log.info("test_files list: {}".format(self.test_files))
             else:
-                log.info("path is not a directory= {}".format(full_path))
+                log.info("did not find tests for {} in = {}".format(sls_path, path))
         return
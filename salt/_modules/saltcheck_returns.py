@@ -7,6 +7,9 @@ This module will make it easy to request data for testing saltcheck assertions
 :codeauthor:    William Cannon <william.cannon@gmail.com>
 :maturity:      new
 '''
+import random
+import string
+import time
 
 __virtualname__ = 'saltcheck_returns'
 
@@ -26,6 +29,12 @@ def __virtual__():
     empty - no value returned at all
     notempty - given string
     bool - True | False
+
+load generators for benchmarks and stress tests, deterministic when seeded:
+    list of size n
+    nested dict of a given depth and breadth
+    random string or bytes payload
+    any of the above returned after a latency with jitter
 '''
         
 
@@ -104,3 +113,60 @@ def get_bool(given_val=True):
     except:
         val = True
     return val
+
+def get_sized_list(size=1000, seed=None):
+    '''
+    Return a list of size strings, in order or shuffled by the seed
+
+    CLI Example:
+        salt '*' saltcheck_returns.get_sized_list 100000
+        salt '*' saltcheck_returns.get_sized_list 100000 seed=42
+    '''
+    val = ['item-{0}'.format(i) for i in range(int(size))]
+    if seed is not None:
+        random.Random(seed).shuffle(val)
+    return val
+
+def get_nested_dict(depth=3, breadth=5, seed=None):
+    '''
+    Return a dict nested depth levels deep with breadth keys per level,
+    leaves are ints, random when seeded
+
+    CLI Example:
+        salt '*' saltcheck_returns.get_nested_dict depth=4 breadth=10
+    '''
+    rand = random.Random(seed) if seed is not None else None
+
+    def _level(remaining, prefix):
+        if remaining <= 0:
+            return rand.randint(0, 1000000) if rand else len(prefix)
+        return dict(('{0}{1}'.format(prefix, i), _level(remaining - 1, '{0}{1}-'.format(prefix, i)))
+                    for i in range(int(breadth)))
+    return _level(int(depth), 'key-')
+
+def get_payload(size=1024, seed=None, binary=False):
+    '''
+    Return a random string of size characters, or bytes when binary is True
+
+    CLI Example:
+        salt '*' saltcheck_returns.get_payload 1048576 seed=1
+    '''
+    rand = random.Random(seed)
+    if binary:
+        return bytes(bytearray(rand.getrandbits(8) for dummy in range(int(size))))
+    alphabet = string.ascii_letters + string.digits
+    return ''.join(rand.choice(alphabet) for dummy in range(int(size)))
+
+def get_delayed(given_val=True, latency=0.1, jitter=0.0, seed=None):
+    '''
+    Return the given value after sleeping latency seconds, plus or minus up
+    to jitter seconds, to simulate a slow module
+
+    CLI Example:
+        salt '*' saltcheck_returns.get_delayed latency=2 jitter=0.5 seed=7
+    '''
+    delay = float(latency)
+    if jitter:
+        delay += random.Random(seed).uniform(-float(jitter), float(jitter))
+    time.sleep(max(delay, 0))
+    return given_val
@@ -0,0 +1,211 @@
+# -*- coding: utf-8 -*-
+'''
+A runner for running saltcheck tests across a fleet of minions
+
+The minions are targeted in batches, each batch running the saltcheck
+execution module. Returns are folded into one fleet summary as they arrive
+and then dropped, so the master only holds the running totals, the count of
+failing minions per state and a bounded list of failing minion ids.
+
+Place this file in the _runners directory of the master file_roots, or
+in runner_dirs, then:
+    salt-run saltutil.sync_runners
+    salt-run saltcheck_runner.run_highstate_tests tgt='web*' batch_size=200
+
+
+Master config options:
+
+saltcheck_batch_size: 100
+  number of minions a batch targets at once
+
+saltcheck_batch_timeout: 600
+  seconds to wait for the returns of a batch before moving on to the next
+
+saltcheck_max_listed_minions: 100
+  failing and non returning minion ids listed in the summary, the counts
+  cover all of them
+
+
+:maturity:      new
+'''
+from __future__ import absolute_import
+import logging
+import time
+from collections import Counter
+try:
+    import salt.client
+    import salt.utils.minions
+except ImportError:
+    pass
+
+log = logging.getLogger(__name__)
+
+SUMMARY_COUNTS = ('Passed', 'Failed', 'Errors', 'Skipped', 'Timed Out', 'Missing Tests', 'Unchanged')
+FAILED_STATUSES = ('Fail', 'Error', 'Timeout')
+
+
+def run_highstate_tests(tgt='*', tgt_type='glob', batch_size=None, timeout=None, **kwargs):
+    '''
+    Run saltcheck.run_highstate_tests on the targeted minions, batch by batch,
+    and return one summary for the fleet
+
+    :param str tgt: the minions to target
+    :param str tgt_type: the type of tgt, glob, list, grain, compound...
+    :param int batch_size: number of minions a batch targets at once
+    :param float timeout: seconds to wait for the returns of a batch
+    :param kwargs: passed on to saltcheck.run_highstate_tests, e.g. parallel,
+        changed_only
+
+    CLI Example::
+      salt-run saltcheck_runner.run_highstate_tests
+      salt-run saltcheck_runner.run_highstate_tests tgt='web*' batch_size=200
+      salt-run saltcheck_runner.run_highstate_tests tgt='os:Ubuntu' tgt_type=grain parallel=4
+    '''
+    return _run_fleet('saltcheck.run_highstate_tests', [], tgt, tgt_type, batch_size, timeout, kwargs)
+
+
+def run_state_tests(state, tgt='*', tgt_type='glob', batch_size=None, timeout=None, **kwargs):
+    '''
+    Run saltcheck.run_state_tests for a state on the targeted minions, batch
+    by batch, and return one summary for the fleet
+
+    :param str state: the name of a user defined state
+    :param str tgt: the minions to target
+    :param str tgt_type: the type of tgt, glob, list, grain, compound...
+    :param int batch_size: number of minions a batch targets at once
+    :param float timeout: seconds to wait for the returns of a batch
+    :param kwargs: passed on to saltcheck.run_state_tests, e.g. parallel
+
+    CLI Example::
+      salt-run saltcheck_runner.run_state_tests apache
+      salt-run saltcheck_runner.run_state_tests apache tgt='web*' batch_size=200
+    '''
+    return _run_fleet('saltcheck.run_state_tests', [state], tgt, tgt_type, batch_size, timeout, kwargs)
+
+
+def _get_client():
+    '''return the LocalClient the batches are sent through'''
+    return salt.client.get_local_client(__opts__['conf_file'])
+
+
+def _get_minions(tgt, tgt_type):
+    '''return the sorted ids of the minions matching the target'''
+    minions = salt.utils.minions.CkMinions(__opts__).check_minions(tgt, tgt_type)
+    # newer salt returns {'minions': [...], 'missing': [...]}
+    if isinstance(minions, dict):
+        minions = minions.get('minions', [])
+    return sorted(minions)
+
+
+def _batches(minions, batch_size):
+    '''yield the minion ids in lists of at most batch_size'''
+    for index in range(0, len(minions), batch_size):
+        yield minions[index:index + batch_size]
+
+
+def _run_fleet(fun, args, tgt, tgt_type, batch_size, timeout, kwargs):
+    '''run a saltcheck function batch by batch, return the FleetSummary dict'''
+    kwargs = dict((key, val) for key, val in kwargs.items() if not key.startswith('__'))
+    batch_size = int(batch_size or __opts__.get('saltcheck_batch_size', 100))
+    timeout = timeout or __opts__.get('saltcheck_batch_timeout', 600)
+    minions = _get_minions(tgt, tgt_type)
+    summary = FleetSummary(max_listed=__opts__.get('saltcheck_max_listed_minions', 100))
+    client = _get_client()
+    start = time.time()
+    for batch in _batches(minions, batch_size):
+        pending = set(batch)
+        for ret in client.cmd_iter(batch, fun, arg=args, kwarg=kwargs, tgt_type='list', timeout=timeout):
+            for minion, data in ret.items():
+                pending.discard(minion)
+                summary.add(minion, data.get('ret') if isinstance(data, dict) else data)
+        for minion in sorted(pending):
+            summary.add_no_return(minion)
+        log.info("saltcheck batch done: {0} of {1} minions".format(summary.minions, len(minions)))
+        _fire_progress(summary, len(minions))
+    output = summary.to_dict()
+    output['Run Time'] = time.time() - start
+    return output
+
+
+def _fire_progress(summary, total):
+    '''report the progress of the run on the runner's event stream'''
+    if '__jid_event__' not in globals():
+        return
+    __jid_event__.fire_event(
+        {'message': 'saltcheck: {0}/{1} minions, {2} failing'.format(
+            summary.minions, total, summary.failed_minions)}, 'progress')
+
+
+def _test_status(value):
+    '''return the status of a test result, in the structured or legacy output'''
+    if isinstance(value, dict):
+        return value.get('status')
+    return str(value).split(':', 1)[0]
+
+
+class FleetSummary(object):
+    '''
+    Running totals of the saltcheck returns of many minions, each return is
+    folded in and can be dropped
+    '''
+
+    def __init__(self, max_listed=100):
+        self.max_listed = max_listed
+        self.minions = 0
+        self.failed_minions = 0
+        self.counts = Counter()
+        self.state_failures = Counter()
+        self.failed = []
+        self.no_return = []
+        self.no_return_count = 0
+        self.bad_returns = []
+        self.bad_return_count = 0
+
+    def _list(self, listing, minion):
+        '''add a minion id to a listing, up to max_listed ids'''
+        if len(listing) < self.max_listed:
+            listing.append(minion)
+
+    def add(self, minion, out_list):
+        '''fold the saltcheck return of a minion into the totals'''
+        self.minions += 1
+        if not isinstance(out_list, list) or not out_list or \
+                'TEST RESULTS' not in out_list[-1]:
+            self.bad_return_count += 1
+            self._list(self.bad_returns, minion)
+            return
+        failed = False
+        for entry in out_list[:-1]:
+            for state, tests in entry.items():
+                if not isinstance(tests, dict):
+                    continue
+                if any(_test_status(value) in FAILED_STATUSES for value in tests.values()):
+                    self.state_failures[state] += 1
+                    failed = True
+        results = out_list[-1]['TEST RESULTS']
+        for key in SUMMARY_COUNTS:
+            self.counts[key] += results.get(key) or 0
+        # streamed minion runs only return the summary
+        if results.get('Failed') or results.get('Errors') or results.get('Timed Out'):
+            failed = True
+        if failed:
+            self.failed_minions += 1
+            self._list(self.failed, minion)
+
+    def add_no_return(self, minion):
+        '''record a targeted minion which did not return in time'''
+        self.minions += 1
+        self.no_return_count += 1
+        self._list(self.no_return, minion)
+
+    def to_dict(self):
+        '''return the fleet summary'''
+        return {'Minions': self.minions,
+                'Minions Failed': self.failed_minions,
+                'Minions Not Returned': self.no_return_count,
+                'Minions Bad Return': self.bad_return_count,
+                'Failed Minions': self.failed,
+                'Not Returned Minions': self.no_return,
+                'Bad Return Minions': self.bad_returns,
+                'State Failures': dict(self.state_failures.most_common()),
+                'TEST RESULTS': dict((key, self.counts[key]) for key in SUMMARY_COUNTS)}
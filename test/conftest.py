@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+'''
+Fixtures loading the saltcheck modules outside of the salt loader, with the
+dunders the loader would inject
+'''
+from __future__ import absolute_import
+import importlib.util
+import os
+
+import pytest
+
+# the unittest suite of the original salt_check script, it needs a live minion
+collect_ignore = ['salt_check_test.py']
+
+ROOT = os.path.join(os.path.abspath(os.path.dirname(__file__)), '..', 'salt')
+
+
+def _load(subdir, name):
+    '''load a module of salt/_modules or salt/_runners'''
+    spec = importlib.util.spec_from_file_location(name, os.path.join(ROOT, subdir, name + '.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+@pytest.fixture
+def config():
+    '''the minion config seen through config.get'''
+    return {'auto_update_master_cache': False}
+
+
+@pytest.fixture
+def saltcheck(tmpdir, config):
+    '''the saltcheck execution module with a cachedir under tmpdir'''
+    module = _load('_modules', 'saltcheck')
+    module.__salt__ = {'config.get': lambda key, default=None: config.get(key, default),
+                       'sys.list_functions': lambda *args: sorted(module.__salt__),
+                       'test.echo': lambda text: text}
+    module.__opts__ = {'cachedir': str(tmpdir.join('cache')), 'environment': None}
+    module.__utils__ = {'files.fopen': open}
+    module.__grains__ = {}
+    module.__pillar__ = {}
+    return module
+
+
+@pytest.fixture
+def saltcheck_runner():
+    '''the saltcheck_runner runner module'''
+    module = _load('_runners', 'saltcheck_runner')
+    module.__opts__ = {}
+    return module
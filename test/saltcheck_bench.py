@@ -0,0 +1,220 @@
+#!/usr/bin/env python
+'''
+Synthetic benchmark for the saltcheck engine
+
+Generates a state tree of N states, M .tst files per state and K tests per
+file calling saltcheck_returns functions, then measures discovery, rendering,
+validation, execution and a full run_highstate_tests against stub __salt__
+and __opts__ dunders, so no master or minion is needed.
+
+Results are written as json, to compare runs across versions:
+    python test/saltcheck_bench.py --states 50 --files 4 --tests 20 --output bench.json
+'''
+from __future__ import absolute_import, print_function
+import argparse
+import importlib.util
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import yaml
+
+MODULES_DIR = os.path.join(os.path.abspath(os.path.dirname(__file__)), '..', 'salt', '_modules')
+
+ASSERTIONS = [
+    ('get_string', ['bench'], 'assertEqual', 'bench'),
+    ('get_int', [42], 'assertGreater', 100),
+    ('get_float', [1.5], 'assertLessEqual', 0.5),
+    ('get_list', [['a', 'b', 'c']], 'assertIn', 'b'),
+    ('get_dict', [{'a': 1}], 'assertNotEqual', {'b': 2}),
+    ('get_bool', [True], 'assertTrue', None),
+    ('get_empty', [], 'assertEmpty', None),
+]
+
+
+def load_module(name):
+    '''load an execution module from salt/_modules'''
+    spec = importlib.util.spec_from_file_location(name, os.path.join(MODULES_DIR, name + '.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def make_tree(root, states, files, tests, templated):
+    '''write the synthetic state tree, return the list of sls'''
+    sls_list = []
+    for state in range(states):
+        sls = 'state{0}'.format(state)
+        sls_list.append(sls)
+        test_dir = os.path.join(root, sls, 'saltcheck-tests')
+        os.makedirs(test_dir)
+        with open(os.path.join(root, sls, 'init.sls'), 'w') as myfile:
+            myfile.write('{0}-noop:\n  test.nop: []\n'.format(sls))
+        for tst in range(files):
+            suite = {}
+            for test in range(tests):
+                fun, args, assertion, expected = ASSERTIONS[(state + tst + test) % len(ASSERTIONS)]
+                # identical calls would be answered by the call cache, time real calls
+                case = {'module_and_function': 'saltcheck_returns.' + fun,
+                        'args': args,
+                        'assertion': assertion,
+                        'cache': False}
+                if expected is not None:
+                    case['expected-return'] = expected
+                suite['{0}-{1}-{2}'.format(sls, tst, test)] = case
+            contents = yaml.safe_dump(suite, default_flow_style=False)
+            if templated and tst % 2:
+                contents = "{% set env = grains['os'] %}\n" + contents
+            with open(os.path.join(test_dir, 'file{0}.tst'.format(tst)), 'w') as myfile:
+                myfile.write(contents)
+    return sls_list
+
+
+def stub_dunders(saltcheck, saltcheck_returns, cachedir, sls_list):
+    '''install the __salt__, __opts__ and friends the loader would provide'''
+    functions = dict(('saltcheck_returns.' + name, getattr(saltcheck_returns, name))
+                     for name in dir(saltcheck_returns) if name.startswith('get_'))
+    config = {'auto_update_master_cache': True,
+              'saltcheck_executor': 'loader'}
+    grains = {'os': 'Bench', 'id': 'bench-minion'}
+
+    def renderer(path):
+        '''yaml_jinja like renderer'''
+        with open(path) as myfile:
+            contents = myfile.read()
+        try:
+            import jinja2
+            contents = jinja2.Template(contents).render(grains=grains, pillar={})
+        except ImportError:
+            contents = '\n'.join(line for line in contents.splitlines() if not line.startswith('{%'))
+        return yaml.safe_load(contents)
+
+    functions.update({
+        'sys.list_functions': lambda *args: sorted(functions),
+        'sys.list_modules': lambda *args: sorted(set(fun.split('.')[0] for fun in functions)),
+        'config.get': lambda key, default=None: config.get(key, default),
+        'cp.cache_master': lambda *args: True,
+        'slsutil.renderer': renderer,
+        'grains.get': lambda key, default='': grains.get(key, default),
+        'pillar.get': lambda key, default='': default,
+        'state.show_lowstate': lambda: [{'__sls__': sls, 'state': 'test', '__id__': sls + '-noop',
+                                         'name': sls + '-noop', 'fun': 'nop'} for sls in sls_list],
+        'state.show_low_sls': lambda state: [{'__sls__': state}],
+    })
+    saltcheck.__salt__ = functions
+    saltcheck.__opts__ = {'cachedir': cachedir, 'environment': None, 'renderer': 'yaml_jinja'}
+    saltcheck.__utils__ = {'files.fopen': open}
+    saltcheck.__grains__ = grains
+    saltcheck.__pillar__ = {}
+    return config
+
+
+def measure(name, func, count):
+    '''run func under tracemalloc, return its figures and result'''
+    tracemalloc.start()
+    start = time.time()
+    value = func()
+    elapsed = time.time() - start
+    dummy, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    figures = {'seconds': elapsed,
+               'tests_per_second': count / elapsed if elapsed else None,
+               'peak_memory_bytes': peak}
+    print('{0:<12} {1:>9.4f}s {2:>12.1f} tests/s {3:>12} bytes peak'.format(
+        name, elapsed, figures['tests_per_second'] or 0, peak))
+    return figures, value
+
+
+def run_benchmark(states, files, tests, templated, parallel):
+    '''build a tree and time each phase of the engine over it'''
+    saltcheck = load_module('saltcheck')
+    saltcheck_returns = load_module('saltcheck_returns')
+    cachedir = tempfile.mkdtemp(prefix='saltcheck-bench-')
+    try:
+        root = os.path.join(cachedir, 'files', 'base')
+        sls_list = make_tree(root, states, files, tests, templated)
+        stub_dunders(saltcheck, saltcheck_returns, cachedir, sls_list)
+        count = states * files * tests
+        phases = {}
+        scheck = saltcheck.SaltCheck()
+        stl = saltcheck._get_state_test_loader(scheck)
+
+        def discover():
+            found = {}
+            for sls in sls_list:
+                stl.add_test_files_for_sls(stl.convert_sls_to_path(sls))
+                found[sls] = stl.test_files
+                stl.test_files = []
+            return found
+        phases['discovery'], found = measure('discovery', discover, count)
+
+        def render():
+            suites = {}
+            for sls in sls_list:
+                stl.test_files = found[sls]
+                stl.load_test_suite()
+                suites[sls] = stl.test_dict
+            return suites
+        phases['rendering'], suites = measure('rendering', render, count)
+        phases['rendering_warm'], dummy = measure('render warm', render, count)
+
+        def validate():
+            return dict((sls, scheck.compile_tests(suite)) for sls, suite in suites.items())
+        phases['validation'], plans = measure('validation', validate, count)
+        valid = sum(1 for suite in plans.values() for plan in suite.values()
+                    if not isinstance(plan, saltcheck.TestResult))
+
+        def execute():
+            return dict((sls, scheck.run_plans(suite, parallel=parallel)) for sls, suite in plans.items())
+        phases['execution'], dummy = measure('execution', execute, count)
+
+        def full_run():
+            return saltcheck.run_highstate_tests(parallel=parallel)
+        phases['run_highstate_tests'], out_list = measure('full run', full_run, count)
+        return {'phases': phases,
+                'valid_tests': valid,
+                'summary': out_list[-1]['TEST RESULTS']}
+    finally:
+        shutil.rmtree(cachedir, ignore_errors=True)
+
+
+def git_revision():
+    '''return the git revision of the tree being benchmarked, if known'''
+    try:
+        return subprocess.check_output(['git', 'describe', '--always', '--dirty'],
+                                       cwd=MODULES_DIR, stderr=subprocess.STDOUT).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(argv=None):
+    '''parse arguments, run the benchmark and write its results'''
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--states', type=int, default=20, help='number of states (N)')
+    parser.add_argument('--files', type=int, default=3, help='.tst files per state (M)')
+    parser.add_argument('--tests', type=int, default=10, help='tests per file (K)')
+    parser.add_argument('--templated', action='store_true', help='add jinja to every other file')
+    parser.add_argument('--parallel', type=int, default=1, help='parallel option of the runs')
+    parser.add_argument('--output', help='write the results as json to this file')
+    args = parser.parse_args(argv)
+
+    results = {'revision': git_revision(),
+               'python': platform.python_version(),
+               'timestamp': time.time(),
+               'parameters': {'states': args.states, 'files': args.files, 'tests': args.tests,
+                              'templated': args.templated, 'parallel': args.parallel}}
+    results.update(run_benchmark(args.states, args.files, args.tests, args.templated, args.parallel))
+    if args.output:
+        with open(args.output, 'w') as myfile:
+            json.dump(results, myfile, indent=2, sort_keys=True, default=str)
+    return results
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
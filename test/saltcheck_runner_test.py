@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+'''
+Tests of the saltcheck_runner fleet aggregation against a stubbed LocalClient
+'''
+from __future__ import absolute_import
+
+
+def _out_list(passed, failed, state_results):
+    '''a minion return of saltcheck.run_highstate_tests'''
+    out_list = [{state: tests} for state, tests in sorted(state_results.items())]
+    out_list.append({'TEST RESULTS': {'Passed': passed, 'Failed': failed, 'Errors': 0, 'Skipped': 0,
+                                      'Timed Out': 0, 'Missing Tests': 0}})
+    return out_list
+
+
+PASSING = _out_list(2, 0, {'apache': {'installed': {'status': 'Pass'}, 'running': 'Pass'}})
+FAILING = _out_list(1, 1, {'apache': {'installed': {'status': 'Pass'},
+                                      'running': {'status': 'Fail', 'message': 'not running'}}})
+LEGACY_FAILING = _out_list(0, 1, {'nginx': {'running': 'Fail: not running'}})
+
+
+class FakeLocalClient(object):
+    '''LocalClient returning canned returns, and recording the batches sent'''
+
+    def __init__(self, returns):
+        self.returns = returns
+        self.calls = []
+
+    def cmd_iter(self, tgt, fun, arg=(), kwarg=None, tgt_type='glob', timeout=None):
+        self.calls.append({'tgt': list(tgt), 'fun': fun, 'arg': arg, 'kwarg': kwarg,
+                           'tgt_type': tgt_type, 'timeout': timeout})
+        for minion in tgt:
+            if minion in self.returns:
+                yield {minion: {'ret': self.returns[minion], 'retcode': 0}}
+
+
+def test_fleet_summary_counts(saltcheck_runner):
+    summary = saltcheck_runner.FleetSummary()
+    summary.add('m1', PASSING)
+    summary.add('m2', FAILING)
+    summary.add('m3', LEGACY_FAILING)
+    summary.add('m4', "'saltcheck' __virtual__ returned False")
+    summary.add_no_return('m5')
+    output = summary.to_dict()
+    assert output['Minions'] == 5
+    assert output['Minions Failed'] == 2
+    assert output['Failed Minions'] == ['m2', 'm3']
+    assert output['Minions Bad Return'] == 1
+    assert output['Bad Return Minions'] == ['m4']
+    assert output['Minions Not Returned'] == 1
+    assert output['State Failures'] == {'apache': 1, 'nginx': 1}
+    assert output['TEST RESULTS']['Passed'] == 3
+    assert output['TEST RESULTS']['Failed'] == 2
+
+
+def test_fleet_summary_summary_only_return(saltcheck_runner):
+    summary = saltcheck_runner.FleetSummary()
+    summary.add('m1', [{'TEST RESULTS': {'Passed': 3, 'Failed': 0, 'Errors': 1}}])
+    output = summary.to_dict()
+    assert output['Minions Failed'] == 1
+    assert output['State Failures'] == {}
+    assert output['TEST RESULTS']['Errors'] == 1
+
+
+def test_fleet_summary_bounds_listed_minions(saltcheck_runner):
+    summary = saltcheck_runner.FleetSummary(max_listed=2)
+    for index in range(5):
+        summary.add('m{0}'.format(index), FAILING)
+        summary.add_no_return('n{0}'.format(index))
+    output = summary.to_dict()
+    assert output['Minions Failed'] == 5
+    assert output['Failed Minions'] == ['m0', 'm1']
+    assert output['Minions Not Returned'] == 5
+    assert output['Not Returned Minions'] == ['n0', 'n1']
+    assert output['State Failures'] == {'apache': 5}
+
+
+def test_run_fleet_batches(saltcheck_runner):
+    minions = ['m{0}'.format(index) for index in range(7)]
+    returns = dict((minion, PASSING) for minion in minions)
+    returns['m4'] = FAILING
+    del returns['m6']
+    client = FakeLocalClient(returns)
+    saltcheck_runner.__opts__ = {'saltcheck_batch_size': 3}
+    saltcheck_runner._get_client = lambda: client
+    saltcheck_runner._get_minions = lambda tgt, tgt_type: minions
+    output = saltcheck_runner.run_highstate_tests(tgt='m*', parallel=4, __pub_fun='x')
+    assert [call['tgt'] for call in client.calls] == [['m0', 'm1', 'm2'], ['m3', 'm4', 'm5'], ['m6']]
+    assert all(call['tgt_type'] == 'list' for call in client.calls)
+    assert client.calls[0]['fun'] == 'saltcheck.run_highstate_tests'
+    assert client.calls[0]['kwarg'] == {'parallel': 4}
+    assert client.calls[0]['timeout'] == 600
+    assert output['Minions'] == 7
+    assert output['Failed Minions'] == ['m4']
+    assert output['Not Returned Minions'] == ['m6']
+    assert output['State Failures'] == {'apache': 1}
+    assert output['TEST RESULTS']['Passed'] == 11
+
+
+def test_run_state_tests_passes_the_state(saltcheck_runner):
+    client = FakeLocalClient({'m1': PASSING})
+    saltcheck_runner._get_client = lambda: client
+    saltcheck_runner._get_minions = lambda tgt, tgt_type: ['m1']
+    output = saltcheck_runner.run_state_tests('apache', batch_size=10, timeout=30)
+    assert client.calls[0]['fun'] == 'saltcheck.run_state_tests'
+    assert client.calls[0]['arg'] == ['apache']
+    assert client.calls[0]['timeout'] == 30
+    assert output['Minions Failed'] == 0
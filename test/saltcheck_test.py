@@ -0,0 +1,683 @@
+# -*- coding: utf-8 -*-
+'''
+Tests of the saltcheck execution module against stubbed salt functions
+'''
+from __future__ import absolute_import
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+import pytest
+import yaml
+
+pytest.importorskip('salt.exceptions')
+
+
+def _sleep(length):
+    '''a test.sleep which does not need a minion'''
+    time.sleep(length)
+    return True
+
+
+def _raise(*args):
+    '''a module function failing with its own exception'''
+    raise ValueError('boom')
+
+
+class FakeMaster(object):
+    '''the cp functions of a minion, serving {salt path: contents} of base'''
+
+    def __init__(self, saltcheck, files):
+        self.saltcheck = saltcheck
+        self.files = files
+        self.hashed = []
+        self.fetched = []
+        saltcheck.__salt__.update({'cp.list_master': self.list_master, 'cp.hash_file': self.hash_file,
+                                   'cp.cache_files': self.cache_files})
+
+    def list_master(self, saltenv):
+        return sorted(self.files)
+
+    def hash_file(self, url, saltenv):
+        self.hashed.append(url[len('salt://'):])
+        contents = self.files.get(url[len('salt://'):])
+        if contents is None:
+            return {}
+        return {'hsum': hashlib.sha256(contents.encode('utf-8')).hexdigest(), 'hash_type': 'sha256'}
+
+    def cache_files(self, urls, saltenv):
+        for url in urls:
+            path = url[len('salt://'):]
+            self.fetched.append(path)
+            local_path = self.saltcheck._get_cache_root(saltenv) + '/' + path
+            self.saltcheck.os.makedirs(self.saltcheck.os.path.dirname(local_path), exist_ok=True)
+            with open(local_path, 'w') as myfile:
+                myfile.write(self.files[path])
+
+
+# timeouts
+
+def test_run_test_reports_timeout(saltcheck):
+    saltcheck.__salt__['test.sleep'] = _sleep
+    start = time.time()
+    result = saltcheck.run_test(test={'module_and_function': 'test.sleep', 'args': [1],
+                                      'assertion': 'assertTrue', 'timeout': 0.2, 'cache': False})
+    assert result['status'] == 'Timeout'
+    assert result['message'] == 'test.sleep did not return within 0.2 seconds'
+    assert time.time() - start < 0.9
+
+
+def test_run_tests_run_wide_timeout(saltcheck):
+    saltcheck.__salt__['test.sleep'] = _sleep
+    out_list = saltcheck.run_tests([{'module_and_function': 'test.sleep', 'args': [1],
+                                     'assertion': 'assertTrue', 'cache': False},
+                                    {'module_and_function': 'test.sleep', 'args': [0],
+                                     'assertion': 'assertTrue', 'cache': False}], timeout=0.2)
+    results = out_list[0]['tests']
+    assert results['test-0']['status'] == 'Timeout'
+    assert results['test-1']['status'] == 'Pass'
+    assert out_list[-1]['TEST RESULTS']['Timed Out'] == 1
+
+
+def test_run_test_reports_module_errors(saltcheck):
+    saltcheck.__salt__['test.exception'] = _raise
+    for timeout in (None, 1):
+        result = saltcheck.run_test(test={'module_and_function': 'test.exception', 'assertion': 'assertTrue',
+                                          'timeout': timeout, 'cache': False})
+        assert result['status'] == 'Error'
+        assert result['message'] == 'ValueError: boom'
+
+
+# call memo
+
+def test_call_cache_memoizes(saltcheck):
+    cache = saltcheck.CallCache()
+    calls = []
+    key = cache.make_key('test.echo', ['a'], {})
+    assert key == cache.make_key(' test.echo ', ('a',), None)
+    for dummy in range(3):
+        assert cache.get_or_call(key, lambda: calls.append(1) or 'a') == 'a'
+    assert len(calls) == 1
+    assert cache.hit_ratio() == 2.0 / 3
+
+
+def test_call_cache_memoizes_errors(saltcheck):
+    cache = saltcheck.CallCache()
+    calls = []
+
+    def fail():
+        calls.append(1)
+        raise ValueError('boom')
+    for dummy in range(2):
+        with pytest.raises(ValueError):
+            cache.get_or_call('key', fail)
+    assert len(calls) == 1
+
+
+def test_call_cache_does_not_memoize_timeouts(saltcheck):
+    cache = saltcheck.CallCache()
+
+    def timeout():
+        raise saltcheck.TestTimeout('test.sleep did not return within 0.2 seconds')
+    with pytest.raises(saltcheck.TestTimeout):
+        cache.get_or_call('key', timeout)
+    assert 'key' not in cache.entries
+    assert cache.get_or_call('key', lambda: 'done') == 'done'
+
+
+def test_call_cache_waiters_use_their_own_timeout(saltcheck):
+    cache = saltcheck.CallCache()
+    started = threading.Event()
+    release = threading.Event()
+
+    def slow():
+        started.set()
+        release.wait(5)
+        return 'slow'
+    owner = threading.Thread(target=cache.get_or_call, args=('key', slow))
+    owner.start()
+    started.wait(5)
+    start = time.time()
+    with pytest.raises(saltcheck.TestTimeout):
+        cache.get_or_call('key', slow, timeout=0.1, name='test.sleep')
+    assert time.time() - start < 2
+    release.set()
+    owner.join()
+    assert cache.get_or_call('key', slow, timeout=0.1) == 'slow'
+
+
+def test_run_tests_share_cached_calls(saltcheck):
+    calls = []
+    saltcheck.__salt__['test.exception'] = lambda: calls.append(1) or _raise()
+    test = {'module_and_function': 'test.exception', 'assertion': 'assertTrue'}
+    out_list = saltcheck.run_tests([test, test, dict(test, timeout=1)], parallel=3)
+    assert [result['message'] for result in out_list[0]['tests'].values()] == ['ValueError: boom'] * 3
+    assert len(calls) == 1
+
+
+def test_run_tests_cached_timeouts(saltcheck):
+    saltcheck.__salt__['test.sleep'] = _sleep
+    test = {'module_and_function': 'test.sleep', 'args': [1], 'assertion': 'assertTrue', 'timeout': 0.2}
+    start = time.time()
+    out_list = saltcheck.run_tests([test, test], parallel=2)
+    assert [result['status'] for result in out_list[0]['tests'].values()] == ['Timeout', 'Timeout']
+    assert time.time() - start < 0.9
+
+
+# render cache
+
+def _render_counter(calls):
+    '''a render function returning the path rendered, counting calls'''
+    def render(filepath):
+        calls.append(filepath)
+        return {'rendered': filepath}
+    return render
+
+
+def test_render_cache_hits_per_path(saltcheck, tmpdir):
+    contents = "echo:\n  module_and_function: test.echo\n  args: [\"{{ grains['id'] }}\"]\n"
+    first = tmpdir.join('apache', 'saltcheck-tests', 'echo.tst')
+    second = tmpdir.join('nginx', 'saltcheck-tests', 'echo.tst')
+    first.write(contents, ensure=True)
+    second.write(contents, ensure=True)
+    saltcheck.__salt__['grains.get'] = lambda key: 'minion-1'
+    cache = saltcheck.RenderCache()
+    calls = []
+    for dummy in range(2):
+        assert cache.load(str(first), _render_counter(calls)) == {'rendered': str(first)}
+        assert cache.load(str(second), _render_counter(calls)) == {'rendered': str(second)}
+    assert calls == [str(first), str(second)]
+    assert (cache.hits, cache.misses) == (2, 2)
+    saltcheck.__salt__['grains.get'] = lambda key: 'minion-2'
+    cache.load(str(first), _render_counter(calls))
+    assert len(calls) == 3
+
+
+@pytest.mark.parametrize('contents', [
+    "{{ tpldir }}",
+    "{{ opts['id'] }}",
+    "{% if saltenv == 'base' %}a: b{% endif %}",
+    "{{ salt['cmd.run']('hostname') }}",
+    "{{ __grains__['id'] }}",
+    "{% import_yaml 'defaults.yaml' as defaults %}",
+    "{% include 'other.tst' %}",
+    "#!py\ndef run():\n    return {}\n",
+])
+def test_render_cache_uncacheable(saltcheck, tmpdir, contents):
+    path = tmpdir.join('test.tst')
+    path.write(contents)
+    assert saltcheck.RenderCache().make_key(str(path)) is None
+
+
+def test_render_cache_cacheable(saltcheck, tmpdir):
+    path = tmpdir.join('test.tst')
+    path.write("{% for user in pillar.get('users', []) %}{{ user }}: {}{% endfor %}\n"
+               "{{ salt['grains.get']('os') }}: {}\n")
+    saltcheck.__salt__['grains.get'] = lambda key: 'Debian'
+    saltcheck.__salt__['pillar.get'] = lambda key: ['root']
+    assert saltcheck.RenderCache().make_key(str(path)) is not None
+
+
+# discovery index
+
+def _tree(tmpdir, dirs):
+    '''create directories with a test file each under tmpdir/tree'''
+    root = tmpdir.join('tree')
+    for reldir in dirs:
+        root.join(reldir, 'test.tst').write('', ensure=True)
+    return root
+
+
+def test_discovery_index_lookup(saltcheck, tmpdir):
+    root = _tree(tmpdir, ['apache/saltcheck-tests', 'apache/saltcheck-tests/more', 'web/nginx/saltcheck-tests',
+                          'web/files'])
+    index = saltcheck.DiscoveryIndex(str(root)).load()
+    assert index.lookup('apache') == [str(root.join('apache/saltcheck-tests/test.tst')),
+                                      str(root.join('apache/saltcheck-tests/more/test.tst'))]
+    assert index.lookup('web/nginx') == [str(root.join('web/nginx/saltcheck-tests/test.tst'))]
+    assert index.lookup('web') == []
+
+
+def test_discovery_index_refresh_matches_a_new_build(saltcheck, tmpdir):
+    root = _tree(tmpdir, ['apache/saltcheck-tests', 'mysql/saltcheck-tests/more', 'web/nginx/saltcheck-tests'])
+    saltcheck.DiscoveryIndex(str(root)).load()
+    root.join('mysql').remove()
+    root.join('web/nginx/saltcheck-tests/new/test.tst').write('', ensure=True)
+    root.join('redis/saltcheck-tests/test.tst').write('', ensure=True)
+    index = saltcheck.DiscoveryIndex(str(root)).load()
+    tmpdir.join('cache').remove()
+    fresh = saltcheck.DiscoveryIndex(str(root)).load()
+    assert (index.dirs, index.children, index.files) == (fresh.dirs, fresh.children, fresh.files)
+    assert sorted(index.tests) == ['apache', 'redis', 'web/nginx']
+    assert len(index.lookup('web/nginx')) == 2
+
+
+# changed-only mode
+
+def _write_tree(tmpdir, files):
+    '''write {relative path: contents} under tmpdir, return its path'''
+    for path, contents in files.items():
+        tmpdir.join(path).write(contents, ensure=True)
+    return str(tmpdir)
+
+
+def test_affected_sls_changed_hash_and_includes(saltcheck, tmpdir):
+    root = _write_tree(tmpdir.join('tree'), {
+        'base/init.sls': 'base-pkg:\n  pkg.installed: []\n',
+        'web/init.sls': 'include:\n  - base\n\nnginx:\n  pkg.installed: []\n',
+        'db/init.sls': 'postgres:\n  pkg.installed: []\n',
+    })
+    stl = saltcheck.StateTestLoader([root], refresh=False)
+    sls_list = ['base', 'web', 'db']
+    manifest = {'base': 'old', 'web': 'h-web', 'db': 'h-db'}
+    hashes = {'base': 'new', 'web': 'h-web', 'db': 'h-db'}
+    affected, unchanged = saltcheck._get_affected_sls(stl, [], sls_list, hashes, manifest)
+    assert affected == ['base', 'web']
+    assert unchanged == ['db']
+
+
+def test_affected_sls_requisites(saltcheck, tmpdir):
+    root = _write_tree(tmpdir.join('tree'), dict(
+        ('{0}/init.sls'.format(sls), '') for sls in ('app', 'config', 'monitor', 'other')))
+    stl = saltcheck.StateTestLoader([root], refresh=False)
+    chunks = [{'__sls__': 'config', 'state': 'file', '__id__': 'app-conf', 'name': '/etc/app.conf'},
+              {'__sls__': 'app', 'state': 'service', '__id__': 'app', 'name': 'app',
+               'watch': [{'file': 'app-conf'}]},
+              {'__sls__': 'monitor', 'state': 'cmd', '__id__': 'probe', 'name': 'probe',
+               'require_in': [{'sls': 'config'}]},
+              {'__sls__': 'other', 'state': 'cmd', '__id__': 'other', 'name': 'other'}]
+    sls_list = ['app', 'config', 'monitor', 'other']
+    hashes = dict((sls, 'h-' + sls) for sls in sls_list)
+    manifest = dict(hashes, monitor='changed')
+    affected, unchanged = saltcheck._get_affected_sls(stl, chunks, sls_list, hashes, manifest)
+    # monitor changed, config is required in by it, app watches config
+    assert affected == ['app', 'config', 'monitor']
+    assert unchanged == ['other']
+
+
+def test_affected_sls_without_manifest_or_file(saltcheck, tmpdir):
+    stl = saltcheck.StateTestLoader([str(tmpdir)], refresh=False)
+    affected, unchanged = saltcheck._get_affected_sls(stl, [], ['a', 'b'], {'a': 'h', 'b': None}, {})
+    assert affected == ['a', 'b']
+    assert unchanged == []
+
+
+def test_sls_includes(saltcheck, tmpdir):
+    path = tmpdir.join('web', 'nginx', 'init.sls')
+    path.write("include:\n"
+               "  - base\n"
+               "  # a comment\n"
+               "  - {{ slspath }}.config\n"
+               "{% if grains['os'] == 'Debian' %}\n"
+               "  - '{{ tpldir }}.debian'\n"
+               "{% endif %}\n"
+               "  - {{ pillar['unknown'] }}\n"
+               "  - .service\n"
+               "  - ..php\n"
+               "  - ...top\n"
+               "  - ....above\n"
+               "\n"
+               "nginx:\n"
+               "  pkg.installed: []\n"
+               "  - ignored\n", ensure=True)
+    assert saltcheck._get_sls_includes(str(path), 'web.nginx') == [
+        'base', 'web.nginx.config', 'web.nginx.debian', 'web.nginx.service', 'web.php', 'top']
+    path = tmpdir.join('web', 'php.sls')
+    path.write("include:\n  - .fpm\n  - ..top\n", ensure=True)
+    assert saltcheck._get_sls_includes(str(path), 'web.php') == ['web.fpm', 'top']
+
+
+ECHO_TEST = 'echo:\n  module_and_function: test.echo\n  args: [a]\n  assertion: assertEqual\n  expected-return: a\n'
+
+
+def test_run_affected_tests_hashes_the_master_sls(saltcheck):
+    master = FakeMaster(saltcheck, {'base/init.sls': 'base-pkg:\n  pkg.installed: []\n',
+                                    'web/init.sls': 'include:\n  - base\n',
+                                    'web/saltcheck-tests/echo.tst': ECHO_TEST,
+                                    'db/init.sls': 'postgres:\n  pkg.installed: []\n',
+                                    'db/saltcheck-tests/echo.tst': ECHO_TEST})
+    saltcheck.__salt__['state.show_lowstate'] = lambda: [
+        {'__sls__': sls, 'state': 'pkg', '__id__': sls, 'name': sls} for sls in ('base', 'web', 'db')]
+
+    def run():
+        summary = saltcheck.run_affected_tests()[-1]['TEST RESULTS']
+        return summary['Passed'], summary['Unchanged States']
+    assert run() == (2, [])
+    # base has no tests, so only the sls sync fetches it
+    assert 'base/init.sls' in master.fetched
+    assert run() == (0, ['base', 'db', 'web'])
+    master.files['base/init.sls'] = 'base-pkg:\n  pkg.latest: []\n'
+    assert run() == (1, ['db'])
+    assert run() == (0, ['base', 'db', 'web'])
+
+
+# saltcheck-tests sync
+
+@pytest.mark.parametrize('auto_update', [False, 'incremental'])
+def test_run_state_tests_syncs_its_own_tests(saltcheck, config, auto_update):
+    config['auto_update_master_cache'] = auto_update
+    master = FakeMaster(saltcheck, {'web/init.sls': '',
+                                    'web/saltcheck-tests/echo.tst': ECHO_TEST,
+                                    'web/saltcheck-tests/other.tst': ECHO_TEST.replace('echo:', 'other:'),
+                                    'db/init.sls': '',
+                                    'db/saltcheck-tests/echo.tst': ECHO_TEST})
+    saltcheck.__salt__['state.show_low_sls'] = lambda state: [{'__sls__': state}]
+
+    def run():
+        master.hashed, master.fetched = [], []
+        return saltcheck.run_state_tests('web')[-1]['TEST RESULTS']['Passed']
+    assert run() == 2
+    assert sorted(master.hashed) == ['web/init.sls', 'web/saltcheck-tests/echo.tst',
+                                     'web/saltcheck-tests/other.tst']
+    assert sorted(master.fetched) == sorted(master.hashed)
+    assert run() == 2
+    assert master.fetched == []
+    master.files['web/saltcheck-tests/echo.tst'] = ECHO_TEST.replace('echo:', 'changed:')
+    del master.files['web/saltcheck-tests/other.tst']
+    assert run() == 1
+    assert master.fetched == ['web/saltcheck-tests/echo.tst']
+    cache_root = saltcheck._get_cache_root('base')
+    assert not saltcheck.os.path.exists(cache_root + '/web/saltcheck-tests/other.tst')
+    assert not saltcheck.os.path.exists(cache_root + '/db')
+
+
+# failure messages
+
+def test_structural_diff_dicts(saltcheck):
+    diff = saltcheck._structural_diff({'a': 1, 'b': 2, 'c': 3}, {'a': 1, 'b': 5, 'd': 4})
+    assert diff == "3 difference(s), first 3: key b: 2 != 5; missing key c; unexpected key d"
+
+
+def test_structural_diff_lists(saltcheck):
+    diff = saltcheck._structural_diff([1, 2, 3], [1, 4])
+    assert diff == "2 difference(s), first 2: index 1: 2 != 4; length 3 != 2"
+
+
+def test_structural_diff_is_bounded(saltcheck):
+    expected = dict(('key{0}'.format(index), index) for index in range(100))
+    returned = dict(('key{0}'.format(index), -index) for index in range(1, 100))
+    diff = saltcheck._structural_diff(expected, returned, max_items=5)
+    assert diff.startswith("100 difference(s), first 5: ")
+    assert diff.count(';') == 4
+
+
+def test_structural_diff_other_types(saltcheck):
+    assert saltcheck._structural_diff('abc', 'abd') is None
+    assert saltcheck._structural_diff({'a': 1}, [1]) is None
+
+
+class HugeRepr(object):
+    '''an object with a long repr'''
+
+    def __repr__(self):
+        return 'x' * 10000
+
+
+@pytest.mark.parametrize('value', [b'\x00' * 1000000, bytearray(1000000), 'x' * 1000000, 10 ** 1000,
+                                   HugeRepr(), [b'\x00' * 1000000, HugeRepr()], {'a': 'x' * 1000000}])
+def test_bounded_format(saltcheck, value):
+    assert len(saltcheck._bounded_format(value)) <= saltcheck.MAX_RENDER_LENGTH
+    assert len(saltcheck._bounded_format(value, 64)) <= 64
+
+
+def test_bounded_format_does_not_copy_payloads(saltcheck):
+    tracemalloc = pytest.importorskip('tracemalloc')
+    expected = {'payload': b'\xff' * 10000000}
+    returned = {'payload': b'\xff' * 9999999}
+    tracemalloc.start()
+    try:
+        message = saltcheck._not_equal_message(expected, returned)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    assert message.startswith("1 difference(s), first 1: key payload: b'\\xff")
+    assert peak < 100000
+
+
+# sharding
+
+def test_sharding_is_a_stable_partition(saltcheck):
+    tests = OrderedDict(('test-{0}'.format(index), {}) for index in range(50))
+    shards = [saltcheck.TestSharding(shard, 3) for shard in range(3)]
+    selected = [sharding.select('apache', tests) for sharding in shards]
+    assert set().union(*selected) == set(tests)
+    assert sum(len(part) for part in selected) == len(tests)
+    for part in selected:
+        assert isinstance(part, OrderedDict)
+        assert list(part) == [key for key in tests if key in part]
+    assert saltcheck.TestSharding(1, 3).select('apache', tests) == selected[1]
+    assert sum(1 for sharding in shards if sharding.owns_state('apache')) == 1
+
+
+def test_sharding_balances_on_durations(saltcheck):
+    durations = {('apache', 'slow'): 10.0, ('apache', 'medium'): 6.0, ('nginx', 'quick-1'): 3.0,
+                 ('nginx', 'quick-2'): 2.0, ('nginx', 'quick-3'): 1.0}
+    shards = [saltcheck.TestSharding(shard, 2, durations=durations) for shard in range(2)]
+    seconds = [sum(value for (sls, test_id), value in durations.items()
+                   if sharding.shard_of(sls, test_id) == sharding.shard) for sharding in shards]
+    assert sorted(seconds) == [11.0, 11.0]
+    assert shards[0].fingerprint == shards[1].fingerprint
+    assert saltcheck.TestSharding(0, 2).fingerprint is None
+
+
+@pytest.mark.parametrize('shard, shards', [(2, 2), (-1, 2), (0, 0), ('a', 2)])
+def test_sharding_rejects_invalid_shards(saltcheck, shard, shards):
+    with pytest.raises(saltcheck.salt.exceptions.SaltInvocationError):
+        saltcheck.TestSharding(shard, shards)
+
+
+def test_load_test_durations(saltcheck, tmpdir):
+    path = tmpdir.join('durations.json')
+    path.write('{"apache": {"slow": 2.5}}')
+    assert saltcheck._load_test_durations(str(path)) == {('apache', 'slow'): 2.5}
+    assert saltcheck._load_test_durations({'nginx': {1: '1'}}) == {('nginx', '1'): 1.0}
+    with pytest.raises(saltcheck.salt.exceptions.SaltInvocationError):
+        saltcheck._load_test_durations(str(tmpdir.join('missing.json')))
+
+
+def _shard_return(shard, shards, states, passed, missing=0, fingerprint=None):
+    '''a return of a shard of run_highstate_tests'''
+    out_list = [{state: tests} for state, tests in sorted(states.items())]
+    out_list.append({'TEST RESULTS': {'Passed': passed, 'Failed': 0, 'Errors': 0, 'Skipped': 0,
+                                      'Timed Out': 0, 'Missing Tests': missing, 'Compile Time': shard + 1.0,
+                                      'Function Index Build Time': 0.5, 'Call Cache Hit Ratio': 0.5,
+                                      'Shard': '{0}/{1}'.format(shard, shards),
+                                      'Shard Durations': fingerprint}})
+    return out_list
+
+
+def test_merge_results(saltcheck):
+    merged = saltcheck.merge_results([
+        _shard_return(0, 2, {'apache': {'a': {'status': 'Pass'}}, 'empty': {}}, 1, missing=1),
+        _shard_return(1, 2, {'apache': {'b': {'status': 'Pass'}}, 'nginx': {'c': {'status': 'Pass'}}}, 2),
+    ])
+    assert merged[:-1] == [{'apache': {'a': {'status': 'Pass'}, 'b': {'status': 'Pass'}}},
+                           {'empty': {}},
+                           {'nginx': {'c': {'status': 'Pass'}}}]
+    summary = merged[-1]['TEST RESULTS']
+    assert summary['Passed'] == 3
+    assert summary['Missing Tests'] == 1
+    assert summary['Compile Time'] == 2.0
+    assert summary['Call Cache Hit Ratio'] == 0.5
+    assert 'Shard' not in summary
+    assert 'Warnings' not in summary
+
+
+def test_merge_results_warns_on_mismatched_shards(saltcheck):
+    merged = saltcheck.merge_results([_shard_return(0, 2, {}, 0, fingerprint='a'),
+                                      _shard_return(1, 2, {}, 0, fingerprint='b')])
+    assert merged[-1]['TEST RESULTS']['Warnings'] == ["shards were split on different shard counts or durations"]
+    merged = saltcheck.merge_results([_shard_return(0, 3, {}, 0), _shard_return(2, 3, {}, 0)])
+    assert merged[-1]['TEST RESULTS']['Warnings'] == ["missing the returns of shards [1]"]
+
+
+def test_sharded_runs_keep_test_order(saltcheck):
+    tests = OrderedDict(('test-{0:02d}'.format(index), {'module_and_function': 'test.echo', 'args': [index],
+                                                        'assertion': 'assertEqual', 'expected-return': index})
+                        for index in range(30, 0, -1))
+    stl = saltcheck.StateTestLoader([], refresh=False)
+    stl.iter_test_suite = lambda: iter([(tests, 'tests.tst')])
+    sharding = saltcheck.TestSharding(0, 2)
+    results = {}
+    for dummy in saltcheck._iter_states_results(saltcheck.SaltCheck(), ['echo'], parallel=4, stl=stl,
+                                                sharding=sharding, results=results):
+        pass
+    assert list(results['echo']) == [key for key in tests if sharding.shard_of('echo', key) == 0]
+
+
+# run history
+
+def test_result_history_record_and_query(saltcheck):
+    history = saltcheck.ResultHistory()
+    assert history.history() == []
+    history.record([('apache', 'slow', 'Pass', 2.0), ('apache', 'quick', 'Pass', 0.1)])
+    history.record([('apache', 'slow', 'Fail', 4.0), ('nginx', 'quick', 'Pass', 0.2)], shard='0/2')
+    rows = history.history(state='apache', test='slow')
+    assert [(row['status'], row['duration'], row['shard']) for row in rows] == [('Fail', 4.0, '0/2'),
+                                                                               ('Pass', 2.0, None)]
+    assert len(history.history(limit=3)) == 3
+    slowest = history.slowest(limit=2)
+    assert [(row['state'], row['test']) for row in slowest] == [('apache', 'slow'), ('nginx', 'quick')]
+    assert slowest[0]['runs'] == 2
+    assert slowest[0]['mean duration'] == 3.0
+    assert slowest[0]['max duration'] == 4.0
+    assert slowest[0]['not passed'] == 1
+    assert history.durations() == {'apache': {'slow': 3.0, 'quick': 0.1}, 'nginx': {'quick': 0.2}}
+
+
+def test_result_history_prunes_old_runs(saltcheck):
+    history = saltcheck.ResultHistory(retention_days=1)
+    history.record([('apache', 'old', 'Pass', 1.0)])
+    conn = history.connect()
+    with conn:
+        conn.execute('UPDATE runs SET started = started - 2 * 86400')
+    conn.close()
+    history.record([('apache', 'new', 'Pass', 1.0)])
+    assert [row['test'] for row in history.history()] == ['new']
+    conn = history.connect()
+    assert conn.execute('SELECT COUNT(*) FROM results').fetchone()[0] == 1
+    conn.close()
+
+
+def test_run_state_tests_records_history(saltcheck, config):
+    config['saltcheck_history'] = True
+    FakeMaster(saltcheck, {'web/saltcheck-tests/echo.tst': ECHO_TEST})
+    saltcheck.__salt__['state.show_low_sls'] = lambda state: [{'__sls__': state}]
+    assert saltcheck.history() == []
+    saltcheck.run_state_tests('web')
+    assert [(row['state'], row['test'], row['status']) for row in saltcheck.history()] == [('web', 'echo', 'Pass')]
+    assert list(saltcheck.export_durations()) == ['web']
+
+
+# compiled plans
+
+@pytest.mark.parametrize('test, message', [
+    ('test.echo', "test must be a dictionary"),
+    ({'module_and_function': 'echo', 'assertion': 'assertTrue'}, "module_and_function must be module.function"),
+    ({'module_and_function': 'nope.echo', 'assertion': 'assertTrue'}, "module nope is not available"),
+    ({'module_and_function': 'test.nope', 'assertion': 'assertTrue'}, "function test.nope is not available"),
+    ({'module_and_function': 'test.echo', 'assertion': 'assertSame'}, "unknown assertion assertSame"),
+    ({'module_and_function': 'test.echo', 'assertion': 'assertEqual'}, "assertEqual requires an expected-return"),
+    ({'module_and_function': 'test.echo', 'assertion': 'assertTrue', 'timeout': 'soon'}, "invalid timeout soon"),
+    ({'module_and_function': 'test.echo', 'assertion': 'assertTrue', 'kwargs': [1]}, "kwargs must be a dictionary"),
+])
+def test_compile_test_rejects_invalid_tests(saltcheck, test, message):
+    with pytest.raises(saltcheck.salt.exceptions.SaltInvocationError) as excinfo:
+        saltcheck.SaltCheck(sync=False).compile_test(test)
+    assert str(excinfo.value).startswith(message)
+
+
+def test_compile_test(saltcheck):
+    scheck = saltcheck.SaltCheck(sync=False, timeout=5)
+    plan = scheck.compile_test({'module_and_function': 'test.echo', 'args': 'a', 'assertion': 'assertEqual',
+                                'expected-return': 'a', 'parallel': False})
+    assert plan.function is saltcheck.__salt__['test.echo']
+    assert (plan.args, plan.kwargs, plan.timeout, plan.parallel, plan.skip) == (('a',), {}, 5.0, False, False)
+    assert plan.cache_key == saltcheck.CallCache.make_key('test.echo', ['a'], {})
+    assert scheck.compile_test({'module_and_function': 'test.echo', 'assertion': 'assertTrue',
+                                'cache': False}).cache_key is None
+    assert scheck.compile_test({'skip': True}).skip
+
+
+@pytest.mark.parametrize('assertion, expected, returned, status', [
+    ('assertEqual', 'a', 'a', 'Pass'), ('assertEqual', 'a', 'b', 'Fail'),
+    ('assertEqual', '1', 1, 'Pass'), ('assertNotEqual', 'a', 'b', 'Pass'),
+    ('assertTrue', None, True, 'Pass'), ('assertTrue', None, 'yes', 'Fail'),
+    ('assertFalse', None, False, 'Pass'), ('assertIn', 'a', ['a', 'b'], 'Pass'),
+    ('assertNotIn', 'c', ['a', 'b'], 'Pass'), ('assertGreater', '3', 2, 'Pass'),
+    ('assertGreaterEqual', '2', 2, 'Pass'), ('assertLess', '1', 2, 'Pass'),
+    ('assertLessEqual', '3', 2, 'Fail'), ('assertEmpty', None, [], 'Pass'),
+    ('assertNotEmpty', None, [], 'Fail'),
+])
+def test_assertion_dispatch(saltcheck, assertion, expected, returned, status):
+    saltcheck.__salt__['test.value'] = lambda: returned
+    test = {'module_and_function': 'test.value', 'assertion': assertion}
+    if expected is not None:
+        test['expected-return'] = expected
+    assert saltcheck.run_test(test=test)['status'] == status
+
+
+def test_run_tests_reports_invalid_tests(saltcheck):
+    out_list = saltcheck.run_tests({'good': {'module_and_function': 'test.echo', 'args': ['a'],
+                                             'assertion': 'assertEqual', 'expected-return': 'a'},
+                                    'bad': {'module_and_function': 'test.nope', 'assertion': 'assertTrue'}})
+    results = out_list[0]['tests']
+    assert results['good']['status'] == 'Pass'
+    assert results['bad'] == {'status': 'Error', 'message': 'invalid test: function test.nope is not available',
+                              'duration': results['bad']['duration']}
+    assert out_list[-1]['TEST RESULTS']['Errors'] == 1
+
+
+# streaming
+
+def _sleepy_tests(count):
+    '''a tests file of echo tests sleeping less the later they come'''
+    return OrderedDict(('test-{0}'.format(index), {'module_and_function': 'test.sleepy_echo',
+                                                   'args': [index, 0.02 * (count - index)],
+                                                   'assertion': 'assertEqual', 'expected-return': index})
+                       for index in range(count))
+
+
+def _stub_state_tests(saltcheck, tests):
+    '''serve tests as the only test file of every state'''
+    def sleepy_echo(value, length):
+        time.sleep(length)
+        return value
+    saltcheck.__salt__['test.sleepy_echo'] = sleepy_echo
+    saltcheck.__salt__['state.show_low_sls'] = lambda state: [{'__sls__': state}]
+    FakeMaster(saltcheck, {'web/saltcheck-tests/tests.tst': yaml.safe_dump(dict(tests), sort_keys=False)})
+
+
+def test_run_state_tests_keeps_test_order(saltcheck):
+    tests = _sleepy_tests(6)
+    _stub_state_tests(saltcheck, tests)
+    out_list = saltcheck.run_state_tests('web', parallel=6)
+    assert list(out_list[0]['web']) == list(tests)
+    assert out_list[-1]['TEST RESULTS']['Passed'] == 6
+
+
+def test_run_state_tests_streams_events(saltcheck):
+    tests = _sleepy_tests(6)
+    _stub_state_tests(saltcheck, tests)
+    events = []
+    saltcheck.__salt__['event.send'] = lambda tag, data: events.append((tag, data))
+    out_list = saltcheck.run_state_tests('web', parallel=6, stream=True)
+    assert len(out_list) == 1
+    assert out_list[0]['TEST RESULTS']['Passed'] == 6
+    tags = [tag for tag, data in events]
+    # parallel tests are reported as they complete, the quickest last test first
+    assert tags == ['saltcheck/result/web/test-{0}'.format(index) for index in range(5, -1, -1)] + \
+        ['saltcheck/result/web']
+    assert events[0][1]['status'] == 'Pass'
+    assert events[0][1]['state'] == 'web'
+    assert events[-1][1]['counts'] == {'Pass': 6}
+
+
+def test_stream_survives_event_failures(saltcheck):
+    _stub_state_tests(saltcheck, _sleepy_tests(2))
+
+    def send(tag, data):
+        raise RuntimeError('no event bus')
+    saltcheck.__salt__['event.send'] = send
+    assert saltcheck.run_state_tests('web', stream=True)[-1]['TEST RESULTS']['Passed'] == 2